@@ -1,13 +1,19 @@
-import os, uuid, logging
+import os, re, uuid, logging
 import threading
+import queue
 import traceback
 import json
+import xml.etree.ElementTree as ET
 import time
 from datetime import datetime, timedelta
 from flask import Flask, flash, request, redirect, url_for, render_template, jsonify, abort, send_from_directory
 from flask_socketio import SocketIO, emit
 from werkzeug.utils import secure_filename
 import subprocess
+from slide_utils import parse_roi, roi_tag
+from slide_manifest import SlideManifest, slide_file_id_name
+from nucleus_store import NucleusStore
+from image_encoders import EXTENSIONS, CONTENT_TYPES
 
 #external python scripts
 patch_script_path = "patch.py"
@@ -17,6 +23,18 @@ merge_script_path = "merge.py"
 #as db
 job_status = {} 
 
+#resident predict.py worker keeps the model loaded between jobs, PREDICT_WORKER=0 runs one process per job
+USE_PREDICT_WORKER = os.environ.get("PREDICT_WORKER", "1") == "1"
+predict_queue = queue.Queue()
+predict_worker = {"process": None, "thread": None, "job_id": None}
+predict_worker_lock = threading.Lock()
+PREDICT_DEVICES = ["auto", "cuda", "cpu"]
+PREDICT_PRECISIONS = ["fp32", "onnx", "onnx-int8"]
+#jobs in these states must stay in job_status until they finish
+ACTIVE_JOB_STATUSES = {"started", "queued", "running"}
+#deep zoom tiles never change under their versioned url, a new merge gets a new version
+PYRAMID_TILE_MAX_AGE = 365 * 24 * 3600
+
 #upload
 UPLOAD_FOLDER = '/app/uploads'
 #UPLOAD_FOLDER = '/mnt/c/Users/haslina.makmur/OneDrive - Cancer Research Malaysia/Documents/TIA_GUI/tia/uploads'
@@ -31,6 +49,15 @@ socketio = SocketIO(app, cors_allowed_origins="*")
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def roi_script_args(roi):
+    """Command line arguments passing a validated roi on to the scripts."""
+    if not roi:
+        return []
+    return ["--roi", json.dumps({key: value for key, value in roi.items() if key != "bbox"})]
+
+def result_id_name(filename, roi=None):
+    return slide_file_id_name(filename, roi)
+
 @app.route("/")
 def index():
     return render_template("index.html")
@@ -56,10 +83,23 @@ def upload_file():
         file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
         file.save(file_path)
 
+        #header only probe, every stage reads the slide manifest instead of reopening the slide
+        try:
+            slide_manifest = SlideManifest.probe(file_path)
+        except Exception as e:
+            logging.error(f"Unreadable slide {filename}: {e}")
+            os.remove(file_path)
+            return jsonify({
+                "success": False,
+                "message": "File is not a readable slide",
+                "error": str(e)
+            })
+
         try:
             return jsonify({
                 "success": True,
                 "filename": filename,
+                "slide": slide_manifest.meta,
                 "message": "File uploaded successfully" 
             })
         except Exception as e:
@@ -88,6 +128,15 @@ def patch_file():
             "success": False, 
             "message": "File not found"
         })
+
+    #optional region of interest in level-0 coordinates
+    try:
+        roi = parse_roi(data.get('roi'), SlideManifest.load(file_path).dimensions)
+    except (ValueError, KeyError, TypeError) as e:
+        return jsonify({
+            "success": False,
+            "message": f"Invalid ROI: {e}"
+        }), 400
     
     #generate unique id
     job_id = str(uuid.uuid4())
@@ -103,7 +152,8 @@ def patch_file():
         "error": "",
         "start_time": start_time.isoformat(),
         "elapsed_seconds": 0,
-        "estimated_total_seconds": 600  # Default estimate: 10 minutes
+        "estimated_total_seconds": 600,  # Default estimate: 10 minutes
+        "roi": roi_tag(roi) if roi else None
     }
 
     #emit initial status
@@ -115,7 +165,7 @@ def patch_file():
     #patching in separate thread
     threading.Thread(
         target=run_patching,
-        args=(job_id, file_path, filename)
+        args=(job_id, file_path, filename, roi)
     ).start()
 
     return jsonify({
@@ -124,7 +174,7 @@ def patch_file():
         "message": "Patching started"
     })
 
-def run_patching(job_id, file_path, filename):
+def run_patching(job_id, file_path, filename, roi=None):
 
     try:
 
@@ -136,7 +186,7 @@ def run_patching(job_id, file_path, filename):
         })
 
         process = subprocess.Popen(
-            ["python", patch_script_path, file_path],
+            ["python", patch_script_path, file_path] + roi_script_args(roi),
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
             text=True,
@@ -154,6 +204,7 @@ def run_patching(job_id, file_path, filename):
             if output:
                 # Process output and update status
                 job_status[job_id]['output'] += output
+                record_encode_stats(job_id, output)
                 
                 if "progress:" in output.lower():
                     try:
@@ -195,9 +246,11 @@ def predict_file():
     data = request.get_json()
     filename = data.get('filename')
 
+    #earlier finished predictions of the file are dropped, a queued or running one is still owned by the worker
     for job_id, job in list(job_status.items()):
-        if job.get('filename') == filename and job.get('type') == 'prediction':
-            del job_status[job_id]
+        if (job.get('filename') == filename and job.get('type') == 'prediction'
+                and job.get('status') not in ACTIVE_JOB_STATUSES):
+            job_status.pop(job_id, None)
 
     if not filename:
         return jsonify({
@@ -212,6 +265,27 @@ def predict_file():
             "success": False, 
             "message": "File not found"
         })
+
+    #optional region of interest in level-0 coordinates
+    try:
+        roi = parse_roi(data.get('roi'), SlideManifest.load(file_path).dimensions)
+    except (ValueError, KeyError, TypeError) as e:
+        return jsonify({
+            "success": False,
+            "message": f"Invalid ROI: {e}"
+        }), 400
+
+    #direct mode segments the slide itself, no patching job needed beforehand
+    direct = bool(data.get('direct', False))
+
+    #inference backend per job, cpu nodes can also use the onnx precisions
+    device = data.get('device', 'auto')
+    precision = data.get('precision', 'fp32')
+    if device not in PREDICT_DEVICES or precision not in PREDICT_PRECISIONS:
+        return jsonify({
+            "success": False,
+            "message": f"Invalid backend: device must be one of {PREDICT_DEVICES}, precision one of {PREDICT_PRECISIONS}"
+        })
     
     #generate unique job id
     job_id = str(uuid.uuid4())
@@ -227,7 +301,11 @@ def predict_file():
         "error": "",
         "start_time": start_time.isoformat(),
         "elapsed_seconds": 0,
-        "estimated_total_seconds": 7200  #default estimate: longer
+        "estimated_total_seconds": 7200,  #default estimate: longer
+        "roi": roi_tag(roi) if roi else None,
+        "direct": direct,
+        "device": device,
+        "precision": precision
     }
 
     #emit an initail job status evnt
@@ -239,7 +317,7 @@ def predict_file():
     #separate thread
     threading.Thread(
         target=run_prediction,
-        args=(job_id, file_path, filename)
+        args=(job_id, file_path, filename, roi, direct, device, precision)
     ).start()
     
     return jsonify({
@@ -248,8 +326,160 @@ def predict_file():
         "message": "Prediction started"
     })
 
+def record_encode_stats(job_id, line):
+    """Pick up an "Encoded <artefact>: N files, B bytes, Ts" line into the job's encode summary."""
+    match = re.search(r'Encoded (\w+): (\d+) files, (\d+) bytes, ([\d.]+)s', line)
+    if match:
+        artefact, files, nbytes, seconds = match.groups()
+        job_status[job_id].setdefault("encoded", {})[artefact] = {
+            "files": int(files), "bytes": int(nbytes), "seconds": float(seconds)}
+
+def update_job_output(job_id, line):
+    """Record a line of script output, picking up "progress:" values and the elapsed time."""
+    if job_id not in job_status:
+        return
+    job_status[job_id]['output'] += line + '\n'
+    record_encode_stats(job_id, line)
+
+    if "progress:" in line.lower():
+        try:
+            progress = float(line.split("progress:")[1].strip().rstrip("%"))
+            job_status[job_id]["progress"] = progress
+        except Exception as e:
+            logging.error(f"Error parsing progress: {e}")
+
+    elapsed = (datetime.now() - datetime.fromisoformat(job_status[job_id]["start_time"])).total_seconds()
+    job_status[job_id]["elapsed_seconds"] = int(elapsed)
+
+def start_predict_worker():
+    """Start the thread feeding the resident prediction worker, once per app process."""
+    with predict_worker_lock:
+        if predict_worker["thread"] is None or not predict_worker["thread"].is_alive():
+            predict_worker["thread"] = threading.Thread(target=run_predict_worker, daemon=True)
+            predict_worker["thread"].start()
+
+def spawn_predict_worker():
+    process = subprocess.Popen(
+        ["python", predict_script_path, "--serve"],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        bufsize=1,
+        universal_newlines=True
+    )
+
+    #stderr belongs to whichever job the worker is running
+    def read_stderr():
+        for line in process.stderr:
+            job_id = predict_worker["job_id"]
+            if job_id in job_status:
+                job_status[job_id]["error"] += line
+                socketio.emit('job_update', {
+                    'job_id': job_id,
+                    'status': job_status[job_id]
+                })
+            else:
+                logging.info(f"Predict worker: {line.rstrip()}")
+
+    stderr_thread = threading.Thread(target=read_stderr)
+    stderr_thread.daemon = True
+    stderr_thread.start()
+
+    logging.info(f"Started prediction worker, pid {process.pid}")
+    return process
+
+def emit_job_update(job_id):
+    if job_id in job_status:
+        socketio.emit('job_update', {
+            'job_id': job_id,
+            'status': job_status[job_id]
+        })
+
+def run_predict_worker():
+    """Send queued prediction jobs to the resident worker one at a time and relay its output into job_status.
+
+    A job removed from job_status meanwhile is skipped, or its output drained
+    and dropped if it is already running, and no exception ends the loop.
+    """
+    #load the model up front, a failed start is retried with the first job
+    try:
+        predict_worker["process"] = spawn_predict_worker()
+    except Exception as e:
+        logging.error(f"Could not start prediction worker: {e}")
+
+    while True:
+        job_id, file_path, roi, direct, device, precision = predict_queue.get()
+        if job_id not in job_status:
+            logging.info(f"Skipping prediction job {job_id}, no longer in job_status")
+            continue
+        try:
+            process = predict_worker["process"]
+            if process is None or process.poll() is not None:
+                process = predict_worker["process"] = spawn_predict_worker()
+            predict_worker["job_id"] = job_id
+
+            job_status[job_id]["status"] = "running"
+            emit_job_update(job_id)
+
+            process.stdin.write(json.dumps({
+                "job_id": job_id,
+                "file_path": file_path,
+                "roi": {key: value for key, value in roi.items() if key != "bbox"} if roi else None,
+                "direct": direct,
+                "device": device,
+                "precision": precision,
+            }) + "\n")
+            process.stdin.flush()
+
+            #no job-end line means the worker died, it is started again for the next job
+            status = "failed"
+            last_update_time = time.time()
+            for line in process.stdout:
+                line = line.strip()
+                if line.startswith("job-end:"):
+                    status = line.split()[-1]
+                    break
+                if line == "worker-ready" or line.startswith("job-start:"):
+                    continue
+
+                update_job_output(job_id, line)
+
+                # Emit updates at least every 1 second
+                if time.time() - last_update_time >= 1:
+                    emit_job_update(job_id)
+                    last_update_time = time.time()
+
+            if job_id in job_status:
+                job_status[job_id]["status"] = status
+            emit_job_update(job_id)
+
+        except Exception as e:
+            if job_id in job_status:
+                job_status[job_id]["status"] = "failed"
+                job_status[job_id]["error"] = str(e)
+            emit_job_update(job_id)
+            logging.error(f"Prediction failed: {str(e)}")
+            logging.error(traceback.format_exc())
+
+        finally:
+            predict_worker["job_id"] = None
+
 #function to run prediction
-def run_prediction(job_id, file_path, filename):
+def predict_backend_args(device="auto", precision="fp32"):
+    return ["--device", device, "--precision", precision]
+
+def run_prediction(job_id, file_path, filename, roi=None, direct=False, device="auto", precision="fp32"):
+    if USE_PREDICT_WORKER:
+        job_status[job_id]["status"] = "queued"
+        socketio.emit('job_update', {
+            'job_id': job_id,
+            'status': job_status[job_id]
+        })
+        start_predict_worker()
+        predict_queue.put((job_id, file_path, roi, direct, device, precision))
+        return
+
     try:
         job_status[job_id]["status"] = "running"
         socketio.emit('job_update', {
@@ -258,7 +488,8 @@ def run_prediction(job_id, file_path, filename):
         })
 
         process = subprocess.Popen(
-            ["python", predict_script_path, file_path],
+            ["python", predict_script_path, file_path] + roi_script_args(roi) + (["--direct"] if direct else [])
+            + predict_backend_args(device, precision),
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
             text=True,
@@ -289,18 +520,7 @@ def run_prediction(job_id, file_path, filename):
 
         for line in process.stdout:
             line = line.strip()
-            job_status[job_id]['output'] += line + '\n'
-            
-            if "progress:" in line.lower():
-                try:
-                    progress = float(line.split("progress:")[1].strip().rstrip("%"))
-                    job_status[job_id]["progress"] = progress
-                except Exception as e:
-                    logging.error(f"Error parsing progress: {e}")
-            
-            # Update elapsed time
-            elapsed = (datetime.now() - datetime.fromisoformat(job_status[job_id]["start_time"])).total_seconds()
-            job_status[job_id]["elapsed_seconds"] = int(elapsed)
+            update_job_output(job_id, line)
             
             # Emit updates at least every 1 second
             if time.time() - last_update_time >= 1:
@@ -413,6 +633,18 @@ def merge_file():
             "success": False, 
             "message": "File not found"
         })
+
+    #optional region of interest in level-0 coordinates
+    try:
+        roi = parse_roi(data.get('roi'), SlideManifest.load(file_path).dimensions)
+    except (ValueError, KeyError, TypeError) as e:
+        return jsonify({
+            "success": False,
+            "message": f"Invalid ROI: {e}"
+        }), 400
+
+    #full resolution deep zoom tiles for the viewer on top of the merged png
+    pyramid = bool(data.get('pyramid', False))
     
     job_id = str(uuid.uuid4())
     start_time = datetime.now()
@@ -427,7 +659,9 @@ def merge_file():
         "error": "",
         "start_time": start_time.isoformat(),
         "elapsed_seconds": 0,
-        "estimated_total_seconds": 3000  #default estimate: longer
+        "estimated_total_seconds": 3000,  #default estimate: longer
+        "roi": roi_tag(roi) if roi else None,
+        "pyramid": pyramid
     }
 
     #emit an initail job status evnt
@@ -439,7 +673,7 @@ def merge_file():
     #separate thread
     threading.Thread(
         target=run_merge,
-        args=(job_id, file_path, filename)
+        args=(job_id, file_path, filename, roi, pyramid)
     ).start()
     
     return jsonify({
@@ -450,7 +684,7 @@ def merge_file():
 
 
     
-def run_merge(job_id, file_path, filename):
+def run_merge(job_id, file_path, filename, roi=None, pyramid=False):
     try:
 
         job_status[job_id]["status"] = "running"
@@ -461,7 +695,7 @@ def run_merge(job_id, file_path, filename):
         })
 
         process = subprocess.Popen(
-            ["python", merge_script_path, file_path],
+            ["python", merge_script_path, file_path] + roi_script_args(roi) + (["--pyramid"] if pyramid else []),
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
             text=True,
@@ -491,6 +725,7 @@ def run_merge(job_id, file_path, filename):
             line = line.strip()
             output_lines.append(line)
             job_status[job_id]["output"] = "\n".join(output_lines)
+            record_encode_stats(job_id, line)
 
             elapsed_time = (datetime.now() - datetime.fromisoformat(job_status[job_id]["start_time"])).total_seconds()
             job_status[job_id]["elapsed_seconds"] = int(elapsed_time)
@@ -547,11 +782,11 @@ def run_merge(job_id, file_path, filename):
 def download_csv():
     filename = request.args.get('filename') 
     #base_name = filename
-    base_name = os.path.splitext(filename)[0]
     try:
-        result_folder = os.path.join(app.config['UPLOAD_FOLDER'], f"{base_name}_Vaha")
+        result_id = result_id_name(filename, parse_roi(request.args.get('roi')))
+        result_folder = os.path.join(app.config['UPLOAD_FOLDER'], result_id)
         
-        csv_name = f"nucleus_info_{base_name}_Vaha.csv"
+        csv_name = f"nucleus_info_{result_id}.csv"
 
         print(f"Looking for csv file in: {result_folder}")
         print(f"Expected file csv {csv_name}")
@@ -582,22 +817,25 @@ def download_csv():
 def download_img():
     filename = request.args.get('filename') 
     #base_name = filename
-    base_name = os.path.splitext(filename)[0]
     try:
-        result_dir = os.path.join(app.config['UPLOAD_FOLDER'], f"{base_name}_Vaha")
+        result_id = result_id_name(filename, parse_roi(request.args.get('roi')))
+        result_dir = os.path.join(app.config['UPLOAD_FOLDER'], result_id)
         
-        img_name = f"Merge_{base_name}_Vaha.png"
+        #merge writes the format set by ENCODE_MERGE, the newest output wins
+        candidates = [(image_format, f"Merge_{result_id}.{extension}") for image_format, extension in EXTENSIONS.items()
+                      if os.path.exists(os.path.join(result_dir, f"Merge_{result_id}.{extension}"))]
 
         print(f"Looking for overlay image file in: {result_dir}")
-        print(f"Expected overlay image {img_name}")
+        print(f"Found overlay images {[img_name for _, img_name in candidates]}")
 
-        img_path = os.path.join(result_dir, img_name)
-        if not os.path.exists(img_path):
+        if not candidates:
             return jsonify({'exists': False, 'message': 'File not found'}), 404
+        image_format, img_name = max(candidates, key=lambda candidate: os.path.getmtime(os.path.join(result_dir, candidate[1])))
 
         response = send_from_directory(
             directory=result_dir,
             path=img_name,
+            mimetype=CONTENT_TYPES[image_format],
             as_attachment=True,
             download_name=img_name
         )
@@ -612,6 +850,100 @@ def download_img():
     except Exception as e:
         return jsonify({'exists': False, 'message': str(e)}), 500
     
+@app.route('/get-pyramid') #, methods=['GET']
+def pyramid_info():
+    """Deep zoom descriptor of the merged overlay as json, with the versioned url its tiles are served from."""
+    filename = request.args.get('filename')
+    try:
+        result_id = result_id_name(filename, parse_roi(request.args.get('roi')))
+        #merge writes every build to its own version directory and points current.json at it
+        current_path = os.path.join(app.config['UPLOAD_FOLDER'], result_id, "pyramid", "current.json")
+        if not os.path.exists(current_path):
+            return jsonify({'exists': False, 'message': 'File not found'}), 404
+        with open(current_path) as f:
+            version = int(json.load(f)["version"])
+        dzi_path = os.path.join(app.config['UPLOAD_FOLDER'], result_id, "pyramid", str(version), f"Merge_{result_id}.dzi")
+
+        image = ET.parse(dzi_path).getroot()
+        size = next(child for child in image if child.tag.endswith("Size"))
+
+        response = jsonify({
+            'exists': True,
+            'url': f"/pyramid/{result_id}/{version}/",
+            'format': image.get("Format"),
+            'overlap': int(image.get("Overlap")),
+            'tile_size': int(image.get("TileSize")),
+            'width': int(size.get("Width")),
+            'height': int(size.get("Height"))
+        })
+        response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
+        return response
+
+    except Exception as e:
+        return jsonify({'exists': False, 'message': str(e)}), 500
+
+@app.route('/pyramid/<result_id>/<int:version>/<int:level>/<tile>')
+def pyramid_tile(result_id, version, level, tile):
+    """One deep zoom tile, cacheable for good since every merge version has its own directory."""
+    response = send_from_directory(
+        directory=app.config['UPLOAD_FOLDER'],
+        path=f"{result_id}/pyramid/{version}/Merge_{result_id}_files/{level}/{tile}"
+    )
+    response.headers["Cache-Control"] = f"public, max-age={PYRAMID_TILE_MAX_AGE}, immutable"
+    return response
+
+@app.route('/get-manifest') #, methods=['GET']
+def download_manifest():
+    """Tile to result mapping of a prediction, also while it is still running."""
+    filename = request.args.get('filename')
+    try:
+        result_id = result_id_name(filename, parse_roi(request.args.get('roi')))
+        manifest_path = os.path.join(app.config['UPLOAD_FOLDER'], result_id, f"result_manifest_{result_id}.json")
+        if not os.path.exists(manifest_path):
+            return jsonify({'exists': False, 'message': 'File not found'}), 404
+
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+        status_counts = {}
+        for tile in manifest["tiles"]:
+            status_counts[tile["status"]] = status_counts.get(tile["status"], 0) + 1
+
+        response = jsonify({'exists': True, 'status_counts': status_counts, **manifest})
+        response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
+        return response
+
+    except Exception as e:
+        return jsonify({'exists': False, 'message': str(e)}), 500
+
+@app.route('/nucleus-counts') #, methods=['GET']
+def nucleus_counts():
+    """Nucleus counts per type for the slide, or for a region given as json like an roi."""
+    filename = request.args.get('filename')
+    try:
+        result_id = result_id_name(filename, parse_roi(request.args.get('roi')))
+        store_dir = os.path.join(app.config['UPLOAD_FOLDER'], result_id, "nuclei")
+        if not NucleusStore.exists(store_dir):
+            return jsonify({'exists': False, 'message': 'File not found'}), 404
+
+        store = NucleusStore(store_dir)
+        region = parse_roi(request.args.get('region'))
+        selection = store.in_region(region) if region else None
+        counts = store.type_counts(selection)
+
+        return jsonify({
+            'exists': True,
+            'region': {key: value for key, value in region.items() if key != "bbox"} if region else None,
+            'total': int(counts.sum()),
+            'counts': dict(zip(["Background", "Epithelial", "Lymphocyte", "Macrophage", "Neutrophil"],
+                               (int(count) for count in counts)))
+        })
+
+    except (ValueError, KeyError, TypeError) as e:
+        return jsonify({'exists': False, 'message': f"Invalid region: {e}"}), 400
+    except Exception as e:
+        return jsonify({'exists': False, 'message': str(e)}), 500
+
 @socketio.on('connect')
 def handle_connect():
     print(f'Client connected: {request.sid}, Origin: {request.headers.get("Origin")}')
@@ -621,6 +953,9 @@ def handle_disconnect():
     print(f'Client disconnected: {request.sid}')
 
 if __name__ == "__main__":
+    #load the model up front, in the reloader child only so the gpu holds one copy
+    if USE_PREDICT_WORKER and os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_predict_worker()
     socketio.run(app, host='0.0.0.0', port=5000, debug=True)
 
 
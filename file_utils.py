@@ -0,0 +1,23 @@
+import os
+import shutil
+import threading
+from contextlib import contextmanager
+
+
+@contextmanager
+def atomic_write(path):
+    """Temp path next to path, renamed over it when the block finishes.
+
+    Readers and concurrent jobs writing the same path only ever see a complete
+    file, or a complete directory when path does not exist yet. A failed write
+    leaves path as it was and removes the temp.
+    """
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.isdir(tmp_path):
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        elif os.path.exists(tmp_path):
+            os.remove(tmp_path)
@@ -0,0 +1,133 @@
+import os
+import time
+import threading
+from PIL import Image
+
+#encoder per artefact, overridden with ENCODE_<ARTEFACT>=png:<level 0-9> | webp:<quality> | webp-lossless | jpeg:<quality>
+DEFAULT_ENCODERS = {
+    "patch": "png:1",    #model input, keep it lossless
+    "overlay": "png:1",  #merge re-encodes them anyway
+    "merge": "webp:85",
+    "pyramid": "jpeg:85",
+}
+DEFAULT_LEVELS = {"png": 6, "webp": 85, "jpeg": 85}
+EXTENSIONS = {"png": "png", "webp": "webp", "jpeg": "jpg"}
+CONTENT_TYPES = {"png": "image/png", "webp": "image/webp", "jpeg": "image/jpeg"}
+#largest width or height a webp can hold
+WEBP_MAX_SIZE = 16383
+#last 12 bytes of every complete png (empty IEND chunk and its crc)
+PNG_TRAILER = b"\x00\x00\x00\x00IEND\xaeB`\x82"
+
+
+class Encoder:
+    """Image format and its one setting: png compression level, webp or jpeg quality, or lossless webp."""
+
+    def __init__(self, format, level=None, lossless=False):
+        if format not in EXTENSIONS:
+            raise ValueError(f"Unsupported image format: {format}")
+        self.format = format
+        self.level = DEFAULT_LEVELS[format] if level is None else level
+        self.lossless = lossless
+
+    @classmethod
+    def parse(cls, spec):
+        """Encoder from a spec like png:1, webp:90, webp-lossless or jpeg:85."""
+        name, _, level = spec.strip().lower().partition(":")
+        if name == "webp-lossless":
+            return cls("webp", lossless=True)
+        name = "jpeg" if name == "jpg" else name
+        return cls(name, int(level) if level else None)
+
+    def __str__(self):
+        return "webp-lossless" if self.lossless else f"{self.format}:{self.level}"
+
+    @property
+    def extension(self):
+        return EXTENSIONS[self.format]
+
+    @property
+    def content_type(self):
+        return CONTENT_TYPES[self.format]
+
+    def fits(self, width, height):
+        return self.format != "webp" or max(width, height) <= WEBP_MAX_SIZE
+
+    def pil_options(self):
+        if self.format == "png":
+            return {"format": "PNG", "compress_level": self.level}
+        if self.format == "webp":
+            return {"format": "WEBP", "lossless": True} if self.lossless else {"format": "WEBP", "quality": self.level}
+        return {"format": "JPEG", "quality": self.level}
+
+    def vips_options(self):
+        """Save options to append to a pyvips output path."""
+        if self.format == "png":
+            return f"[compression={self.level}]"
+        if self.format == "webp" and self.lossless:
+            return "[lossless]"
+        return f"[Q={self.level}]"
+
+def encoder_for(artefact):
+    return Encoder.parse(os.environ.get(f"ENCODE_{artefact.upper()}", DEFAULT_ENCODERS[artefact]))
+
+def image_extensions():
+    return set(EXTENSIONS.values())
+
+def encoded_complete(path):
+    """True when an image file was written to the end, from its trailer, for resuming."""
+    try:
+        size = os.path.getsize(path)
+        with open(path, 'rb') as f:
+            if path.endswith(".png"):
+                f.seek(-12, os.SEEK_END)
+                return size >= 12 and f.read() == PNG_TRAILER
+            if path.endswith(".jpg"):
+                f.seek(-2, os.SEEK_END)
+                return size >= 2 and f.read() == b"\xff\xd9"
+            #webp: the riff header holds the size of the rest of the file
+            header = f.read(8)
+            return len(header) == 8 and header[:4] == b"RIFF" and int.from_bytes(header[4:], "little") + 8 == size
+    except OSError:
+        return False
+
+class EncodeStats:
+    """Files, bytes and seconds spent encoding, per artefact.
+
+    Each process keeps its own; pool workers hand theirs back with take() and the
+    parent adds them in with add().
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def record(self, artefact, nbytes, seconds):
+        with self.lock:
+            files, total_bytes, total_seconds = self.stats.get(artefact, (0, 0, 0.0))
+            self.stats[artefact] = (files + 1, total_bytes + nbytes, total_seconds + seconds)
+
+    def add(self, stats):
+        with self.lock:
+            for artefact, (files, nbytes, seconds) in stats.items():
+                total_files, total_bytes, total_seconds = self.stats.get(artefact, (0, 0, 0.0))
+                self.stats[artefact] = (total_files + files, total_bytes + nbytes, total_seconds + seconds)
+
+    def take(self):
+        with self.lock:
+            stats, self.stats = self.stats, {}
+        return stats
+
+    def summary(self):
+        """One "Encoded" line per artefact, app.py picks these up for the job summary."""
+        with self.lock:
+            return [f"Encoded {artefact}: {files} files, {nbytes} bytes, {seconds:.2f}s"
+                    for artefact, (files, nbytes, seconds) in self.stats.items()]
+
+#per process
+encode_stats = EncodeStats()
+
+def write_rgb(path, image, encoder, artefact):
+    """Encode an RGB array with PIL and record the bytes and time."""
+    start = time.time()
+    Image.fromarray(image).save(path, **encoder.pil_options())
+    encode_stats.record(artefact, os.path.getsize(path), time.time() - start)
@@ -1,9 +1,16 @@
 import pyvips
 import os, re, time, sys
+import json
+import shutil
+import argparse
 import logging, warnings
 import numpy as np
-from openslide import OpenSlide
-import tifffile
+from slide_utils import open_slide, read_thumbnail, parse_roi
+from slide_manifest import SlideManifest, TILE_SIZE
+from patch_store import PatchStore
+from result_manifest import ResultManifest, COUNTED
+from image_encoders import Encoder, encoder_for, image_extensions, encode_stats
+from file_utils import atomic_write
 from logging.handlers import RotatingFileHandler
 
 
@@ -27,7 +34,116 @@ logging.basicConfig(level=logging.INFO,
                         RotatingFileHandler(log_file_path, maxBytes=10485760, backupCount=5)
                     ])
 
-def mergeImages(file_id_name, width, height):
+#glass colour for the flat background fill
+FLAT_BACKGROUND = [240, 240, 240]
+#longest side of the slide read used to synthesize the background
+BACKGROUND_SIZE = 4096
+
+#output size relative to level 0
+MERGE_SCALE = float(os.environ.get("MERGE_SCALE", 0.1))
+
+def slide_background(file_path, width, height, background="slide"):
+    """Output sized background for grid cells without a blank tile, upsampled lazily by pyvips."""
+    if background == "flat" or file_path is None:
+        return (pyvips.Image.black(width, height, bands=3) + FLAT_BACKGROUND).cast("uchar")
+
+    slide, if_openslide = open_slide(file_path)
+    thumbnail = np.ascontiguousarray(read_thumbnail(slide, if_openslide, BACKGROUND_SIZE))
+    slide.close()
+
+    thumb = pyvips.Image.new_from_memory(thumbnail.data, thumbnail.shape[1], thumbnail.shape[0], 3, "uchar")
+    upsampled = thumb.resize(width / thumb.width, vscale=height / thumb.height, kernel="nearest")
+    return upsampled.gravity("north-west", width, height)
+
+#merged image and deep zoom tile formats, ENCODE_MERGE and ENCODE_PYRAMID
+MERGE_ENCODER = encoder_for("merge")
+PYRAMID_ENCODER = encoder_for("pyramid")
+PYRAMID_TILE_SIZE = 254
+
+def overlay_extent(rendered, overlay_scale, tile_size, remaining):
+    """Level-0 width or height of an overlay rendered at overlay_scale.
+
+    Scaling the rendered size back is off by the rounding, so it is matched
+    against the two sizes a tile can have: the full tile, as openslide and direct
+    mode pad it at the slide edge, or the tile cropped at the edge, as BifSlide
+    reads it. remaining is the slide extent left from the tile's position.
+    """
+    for extent in (tile_size, min(tile_size, remaining)):
+        if round(extent * overlay_scale) == rendered:
+            return extent
+    return round(rendered / overlay_scale)
+
+def directory_bytes(directory):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(directory) for name in names)
+
+def write_merged(image, file_id_name, encoder=MERGE_ENCODER):
+    """Merge_<id>.<ext> in the merge encoder's format, png when the image is too large for webp."""
+    if not encoder.fits(image.width, image.height):
+        print(f"{image.width}x{image.height} is too large for {encoder}, writing png")
+        encoder = Encoder("png")
+    merged_path = f"./uploads/{file_id_name}/Merge_{file_id_name}.{encoder.extension}"
+    #a merge in another format must not leave the old output to be served
+    for extension in image_extensions() - {encoder.extension}:
+        stale_path = f"./uploads/{file_id_name}/Merge_{file_id_name}.{extension}"
+        if os.path.exists(stale_path):
+            os.remove(stale_path)
+
+    #the write also runs the lazy tile pipeline, so the time covers decoding and shrinking the tiles too
+    start = time.time()
+    image.write_to_file(merged_path + encoder.vips_options())
+    encode_stats.record("merge", os.path.getsize(merged_path), time.time() - start)
+    print(f"Merged image written as {encoder}: {merged_path}")
+    return merged_path
+
+def pyramid_dir(file_id_name):
+    return f"./uploads/{file_id_name}/pyramid/"
+
+def write_pyramid(image, file_id_name, progress_start=80, progress_end=98):
+    """Deep zoom tile tree pyramid/<version>/Merge_<id>.dzi + Merge_<id>_files/ of the image.
+
+    Every build gets its own version directory and pyramid/current.json is then
+    pointed at it, so the previous tree is served until the switch. The version
+    before is kept for viewers still showing it, older ones are removed.
+    """
+    base_dir = pyramid_dir(file_id_name)
+    os.makedirs(base_dir, exist_ok=True)
+    version = time.time_ns()
+    version_dir = os.path.join(base_dir, str(version))
+
+    #dzsave evaluates the whole image in one pass, its progress is mapped onto the job progress
+    last_percent = [-1]
+    def eval_progress(image, progress):
+        percent = progress_start + (progress_end - progress_start) * progress.percent // 100
+        if percent != last_percent[0]:
+            last_percent[0] = percent
+            print(f"progress: {percent}%")
+            sys.stdout.flush()
+    image.set_progress(True)
+    image.signal_connect("eval", eval_progress)
+
+    start = time.time()
+    with atomic_write(version_dir) as tmp_dir:
+        os.makedirs(tmp_dir)
+        image.dzsave(os.path.join(tmp_dir, f"Merge_{file_id_name}"), tile_size=PYRAMID_TILE_SIZE,
+                     overlap=1, suffix=f".{PYRAMID_ENCODER.extension}{PYRAMID_ENCODER.vips_options()}")
+        encode_stats.record("pyramid", directory_bytes(tmp_dir), time.time() - start)
+    with atomic_write(os.path.join(base_dir, "current.json")) as tmp_path:
+        with open(tmp_path, 'w') as f:
+            json.dump({"version": version}, f)
+
+    #the two newest versions stay, the tree of the old single version layout goes too
+    versions = sorted(int(name) for name in os.listdir(base_dir) if name.isdigit())
+    stale = [str(old) for old in versions[:-2]] + [f"Merge_{file_id_name}.dzi", f"Merge_{file_id_name}_files"]
+    for name in stale:
+        path = os.path.join(base_dir, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.exists(path):
+            os.remove(path)
+    print(f"Pyramid {image.width}x{image.height} written as {PYRAMID_ENCODER} to {version_dir}")
+
+def mergeImages(file_id_name, width, height, file_path=None, background="slide", crop_box=None, scale=MERGE_SCALE, pyramid=False,
+                tile_size=TILE_SIZE):
     start_time = time.time()
 
     #initiate progress
@@ -38,123 +154,176 @@ def mergeImages(file_id_name, width, height):
     dir1 = f"./uploads/{file_id_name}/blank/"
     dir2 = f"./uploads/{file_id_name}/overlay/"
 
-    # Function to load and store tiles with coordinates
+    #ensuring all images have same number of bands
+    def to_rgb(img):
+        if img.bands == 1:
+            img = img.bandjoin([img, img, img])  # Convert grayscale to RGB
+        elif img.bands == 2:
+            img = img.extract_band(0, n=3)  # Keep only first band and replicate
+        elif img.bands == 4:
+            img = img.flatten()  # Remove alpha channel
+        return img
+
+    #tiles are (x, y, source, level-0 width, level-0 height), source is a png path or an in-memory image
+    #only headers are read here, pixels are decoded once the tile is shrunk to the output scale
     def load_tiles_from_directory(directory):
         tiles = []
-        tile_size = None
 
         for filename in os.listdir(directory):
-            if filename.endswith(".png"):
-                match = re.search(r'(\d+)_(\d+)\.png$', filename)
+            if os.path.splitext(filename)[1][1:] in image_extensions():
+                match = re.search(r'(\d+)_(\d+)\.\w+$', filename)
                 if match:
                     x, y = map(int, match.groups())
-                    img = pyvips.Image.new_from_file(os.path.join(directory, filename))
+                    path = os.path.join(directory, filename)
+                    header = pyvips.Image.new_from_file(path)
+                    tiles.append((x, y, path, header.width, header.height))
 
-                    #ensuring all images have same number of bands
-                    if img.bands == 1:
-                        img = img.bandjoin([img, img, img])  # Convert grayscale to RGB
-                    elif img.bands == 2:
-                        img = img.extract_band(0, n=3)  # Keep only first band and replicate
-                    elif img.bands == 4:
-                        img = img.flatten()  # Remove alpha channel
-                    if tile_size is None:
-                        tile_size = img.width, img.height
-                    tiles.append((x, y, img))
+        return tiles
 
-        return tiles, tile_size
+    #overlays of the counted tiles, positions straight from the result manifest
+    def load_tiles_from_manifest(manifest):
+        tiles = []
+        #overlays may be rendered below tile resolution, their level-0 size is scaled back
+        overlay_scale = manifest.meta.get("overlay_scale", 1.0)
+        for i in manifest.indices(COUNTED):
+            x, y = manifest.tiles[i]["x"], manifest.tiles[i]["y"]
+            path = manifest.overlay_path(i)
+            header = pyvips.Image.new_from_file(path)
+            tiles.append((x, y, path, overlay_extent(header.width, overlay_scale, tile_size, width - x),
+                          overlay_extent(header.height, overlay_scale, tile_size, height - y)))
+        return tiles
+
+    #blank tiles from the memory-mapped patch store, no png decode
+    def load_tiles_from_store(store, patch_type):
+        tiles = []
+        for x, y, _ in store.tiles(patch_type):
+            tile = np.ascontiguousarray(store.read(x, y))
+            img = pyvips.Image.new_from_memory(tile.data, tile.shape[1], tile.shape[0], 3, "uchar")
+            tiles.append((x, y, img, img.width, img.height))
+        return tiles
+
+    #one tile at the output scale, pngs go through thumbnail so libvips shrinks while decoding
+    def shrink_tile(source, tile_width, tile_height):
+        if isinstance(source, str):
+            img = pyvips.Image.thumbnail(source, tile_width, height=tile_height, size="force")
+        else:
+            img = source.thumbnail_image(tile_width, height=tile_height, size="force")
+        return to_rgb(img)
 
     # Load tiles from both directories
-    tiles1, tile_size1 = load_tiles_from_directory(dir1)
-    tiles2, tile_size2 = load_tiles_from_directory(dir2)
+    store_dir = f"./uploads/{file_id_name}/"
+    if PatchStore.exists(store_dir, file_id_name):
+        store = PatchStore(store_dir, file_id_name)
+        if store.blank_tiles_written:
+            tiles1 = load_tiles_from_store(store, "blank")
+        else:
+            tiles1 = []
+    else:
+        tiles1 = load_tiles_from_directory(dir1)
+    manifest = ResultManifest.load(file_id_name)
+    if manifest is not None:
+        tiles2 = load_tiles_from_manifest(manifest)
+    else:
+        tiles2 = load_tiles_from_directory(dir2)
 
     # Combine tiles from both directories
     all_tiles = tiles1 + tiles2
-    tile_size = tile_size1 if tile_size1 else tile_size2
     print(f"Tile size of {file_id_name}: ", tile_size)
 
     #update progress after loading tiles
     print("progress: 10%")
     sys.stdout.flush()
 
-    # Sort tiles by their coordinates
-    all_tiles.sort(key=lambda t: (t[1], t[0]))
+    #blank tiles were only recorded by patching, the grid is filled from the slide itself
+    synthesize_background = not tiles1 and background != "black"
+    #the grid step is the slide's tile size, never taken from the tiles: edge tiles are cropped
+    #smaller and overlays can be rendered below tile resolution
+    tile_width = tile_height = tile_size
 
     # Determine the size of the full image
-    min_x = min(x for x, y, img in all_tiles)
-    min_y = min(y for x, y, img in all_tiles)
-    max_x = max(x for x, y, img in all_tiles)
-    max_y = max(y for x, y, img in all_tiles)
+    if synthesize_background:
+        #the tile grid always starts at the slide origin
+        min_x, min_y = 0, 0
+        full_image_width, full_image_height = width, height
+    else:
+        min_x = min(tile[0] for tile in all_tiles)
+        min_y = min(tile[1] for tile in all_tiles)
+        max_x = max(tile[0] for tile in all_tiles)
+        max_y = max(tile[1] for tile in all_tiles)
 
-    full_image_width = max_x - min_x + tile_size[0]
-    full_image_height = max_y - min_y + tile_size[1]
+        full_image_width = max_x - min_x + tile_width
+        full_image_height = max_y - min_y + tile_height
     print("Full image width: ", full_image_width)
     print("Full image height: ", full_image_height)
 
-
-    # Create a blank image (20% progress)
+    #one output sized image per grid cell, overlays win over blank tiles at the same position
+    cells = {}
+    for x, y, source, w, h in tiles1 + tiles2:
+        cells[((y - min_y) // tile_height, (x - min_x) // tile_width)] = (source, w, h)
+    cols = -(-full_image_width // tile_width)
+    rows = -(-full_image_height // tile_height)
+    if synthesize_background:
+        print(f"Background synthesized from: {background if file_path else 'flat'}")
+
+    #the merged image at a scale of level 0, cropped to the slide or roi box
+    def mosaic(scale):
+        #a grid cell is a whole number of output pixels, so the scale is snapped to the tile size
+        cell_width = max(1, round(tile_width * scale))
+        cell_height = max(1, round(tile_height * scale))
+        scale_x, scale_y = cell_width / tile_width, cell_height / tile_height
+        print(f"Output scale: {scale_x:.4f} x {scale_y:.4f}, cell {cell_width}x{cell_height}")
+
+        if synthesize_background:
+            background_image = slide_background(file_path, max(1, round(full_image_width * scale_x)),
+                                                max(1, round(full_image_height * scale_y)), background)
+            #padded to the whole grid so every cell crop is in bounds
+            background_image = background_image.gravity("north-west", cols * cell_width, rows * cell_height)
+        else:
+            background_image = None
+        black_cell = pyvips.Image.black(cell_width, cell_height, bands=3)
+
+        def cell_image(row, col):
+            if (row, col) in cells:
+                source, w, h = cells[(row, col)]
+                return shrink_tile(source, min(cell_width, max(1, round(w * scale_x))),
+                                   min(cell_height, max(1, round(h * scale_y))))
+            #cells without a tile show the background, cropped lazily from the one background image
+            if background_image is None:
+                return black_cell
+            return background_image.crop(col * cell_width, row * cell_height, cell_width, cell_height)
+
+        grid = [cell_image(row, col) for row in range(rows) for col in range(cols)]
+
+        #a single arrayjoin over the whole grid of scaled tiles, the level-0 mosaic is never built
+        full_image = pyvips.Image.arrayjoin(grid, across=cols, hspacing=cell_width, vspacing=cell_height)
+
+        # Define the crop area (left, top, width, height), the whole slide or the roi bounding box, at the output scale
+        crop_x, crop_y, crop_width, crop_height = crop_box if crop_box else (0, 0, width, height)
+        left = min(round(max(0, crop_x - min_x) * scale_x), full_image.width - 1)  # Starting x-coordinate
+        top = min(round(max(0, crop_y - min_y) * scale_y), full_image.height - 1)  # Starting y-coordinate
+        crop_width = max(1, min(round(crop_width * scale_x), full_image.width - left))
+        crop_height = max(1, min(round(crop_height * scale_y), full_image.height - top))
+        return full_image.crop(left, top, crop_width, crop_height)
+
+    # Build the merged image (20% progress)
     print("progress: 20%")
     sys.stdout.flush()
-    full_image = pyvips.Image.black(full_image_width, full_image_height, bands=3)
-
-    # Composite each tile into the correct position
-    total_tiles = len(all_tiles)
-    for i, (x, y, img) in enumerate(all_tiles):
-        left = x - min_x
-        top = y - min_y
-
-        # Ensure the image has exactly 3 bands before inserting
-        if img.bands != 3:
-            if img.bands == 1:
-                img = img.bandjoin([img, img, img])
-            elif img.bands == 2:
-                img = img.extract_band(0, n=3)
-            elif img.bands == 4:
-                img = img.flatten()
-
-        full_image = full_image.insert(img, left, top, expand=True) #insert
-
-        #progress based on tiles processed
-        progress = 20 + (i / total_tiles) * 50
-        print(f"progress: {progress:.1f}%")
-        sys.stdout.flush()
-
-
-    #save temp image (80%)
-    print("progress: 80%")
-    sys.stdout.flush()
-    full_image.write_to_file(f"./uploads/{file_id_name}/merged_temp_{file_id_name}.png", Q=85)
-
-    #load temp img (85%)
-    print("progress: 85%")
-    sys.stdout.flush()
-    full_image = pyvips.Image.new_from_file(f"./uploads/{file_id_name}/merged_temp_{file_id_name}.png", access="sequential")
-
-    # Define the crop area (left, top, width, height)
-    left = 0  # Starting x-coordinate
-    top = 0   # Starting y-coordinate
-    crop_width = width #int(input(f"Enter x dimension for {file_id}: "))
-    crop_height = height #int(input(f"Enter y dimension for {file_id}: "))
-
-    # Crop the image
-    print("progress: 90%")
-    sys.stdout.flush()
-    cropped_image = full_image.crop(left, top, crop_width, crop_height)
-
-    # Resize the cropped image by 10% of its original dimensions
-    print("progress: 95%")
-    sys.stdout.flush()
-    resized_image = cropped_image.resize(0.1) #10% of original
+    merged_image = mosaic(scale)
+    print(f"Grid of {cols}x{rows} cells, {len(cells)} tiles")
 
     # Save the final merged image
-    print("progress: 98%")
+    print("progress: 70%")
     sys.stdout.flush()
-    resized_image.write_to_file(f"./uploads/{file_id_name}/Merge_{file_id_name}.png", Q=85)
+    write_merged(merged_image, file_id_name)
 
-    # Remove temp file to free space
-    print("progress: 99%")
-    sys.stdout.flush()
-    os.remove(f"./uploads/{file_id_name}/merged_temp_{file_id_name}.png")
-    print("Temp file removed")
+    #deep zoom tile tree of the full resolution overlay for the viewer
+    if pyramid:
+        print("progress: 80%")
+        sys.stdout.flush()
+        write_pyramid(mosaic(1.0), file_id_name)
+
+    for line in encode_stats.summary():
+        print(line)
 
     #final progress
     print("progress: 100%")
@@ -168,22 +337,18 @@ def mergeImages(file_id_name, width, height):
     
     return True
 
-def main(file_path):
-    norm_method = "Vaha"
-    filename = os.path.basename(file_path)
-    file_id = os.path.splitext(filename)[0]
-    file_id_name = f"{file_id}_{norm_method}"
-
-    if file_path.endswith('.svs') or file_path.endswith('.tif'):
-        slide = OpenSlide(file_path)
-        width, height = slide.level_dimensions[0]
-
-    elif file_path.endswith('.bif'):
-        with tifffile.TiffFile(file_path) as tif:
-            slide_array = tif.pages[2].asarray()
-            height, width = slide_array.shape[:2]
-    else:
-        raise ValueError("Unsupported file type")
+def main(file_path, background="slide", roi=None, scale=MERGE_SCALE, pyramid=False):
+    #dimensions and output names from the header probe made at upload, the slide itself is not opened
+    slide_manifest = SlideManifest.load(file_path)
+    width, height = slide_manifest.dimensions
+    #roi runs merge only the roi tiles and crop the output to its bounding box
+    try:
+        roi = parse_roi(roi, (width, height))
+    except ValueError as e:
+        logging.error(f"Invalid ROI for {file_path}: {e}")
+        print(f"Invalid ROI: {e}")
+        return False
+    file_id_name = slide_manifest.file_id_name(roi)
 
     #create log file
     time_log_path = f"./uploads/{file_id_name}/merge-log.txt"
@@ -192,7 +357,12 @@ def main(file_path):
     with open(time_log_path, 'a') as time_log_file:
         start_time = time.time()
         try:
-            result = mergeImages(file_id_name, width, height)
+            crop_box = None
+            if roi:
+                bx, by, bw, bh = roi["bbox"]
+                crop_box = (bx, by, bw, bh)
+            result = mergeImages(file_id_name, width, height, file_path, background, crop_box, scale, pyramid,
+                                 slide_manifest.tile_size)
             if result:
                 elapsed_time = time.time() - start_time
                 minutes = int(elapsed_time // 60)
@@ -210,9 +380,18 @@ def main(file_path):
             time_log_file.write(f"File ID: {file_id_name}, Exception: {exc}\n")
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python merge.py <filepath>")
-        sys.exit(1)
-    
-    file_path = sys.argv[1]
-    main(file_path)
\ No newline at end of file
+    parser = argparse.ArgumentParser(usage="python merge.py <filepath> [--background slide|flat|black] [--roi JSON] [--scale S] [--pyramid]")
+    parser.add_argument("file_path")
+    parser.add_argument("--background", choices=["slide", "flat", "black"], default=os.environ.get("MERGE_BACKGROUND", "slide"),
+                        help="fill for grid cells without a blank tile: low resolution slide read, flat glass colour or black")
+    parser.add_argument("--roi", default=None,
+                        help='level-0 region as json, {"x", "y", "width", "height"} or {"polygon": [[x, y], ...]}')
+    parser.add_argument("--scale", type=float, default=MERGE_SCALE,
+                        help="output size relative to level 0, 0 < scale <= 1")
+    parser.add_argument("--pyramid", action="store_true", default=os.environ.get("MERGE_PYRAMID", "0") == "1",
+                        help="also write a full resolution deep zoom tile tree for the viewer")
+    args = parser.parse_args()
+    if not 0 < args.scale <= 1:
+        parser.error("--scale must be in (0, 1]")
+
+    main(args.file_path, background=args.background, roi=args.roi, scale=args.scale, pyramid=args.pyramid)
\ No newline at end of file
@@ -0,0 +1,147 @@
+import os
+import json
+import shutil
+import numpy as np
+from file_utils import atomic_write
+
+#one .npy per column, N rows per nucleus column, contours ragged through offsets into points
+COLUMNS = {
+    "centroid_x": (np.float32, ()),
+    "centroid_y": (np.float32, ()),
+    "type": (np.int16, ()),
+    "prob": (np.float32, ()),
+    "bbox": (np.int32, (4,)),
+    "tile": (np.int32, ()),
+}
+NUM_TYPES = 5
+
+
+def nucleus_columns(tile_preds, x, y, tile_index):
+    """Columns for one tile's nuclei, tile coordinates moved to level 0."""
+    nuclei = list(tile_preds.values())
+    offset = np.array([x, y])
+    contours = [np.asarray(nucleus["contour"]).reshape(-1, 2) + offset for nucleus in nuclei]
+
+    return {
+        "centroid_x": np.array([nucleus["centroid"][0] for nucleus in nuclei], dtype=np.float32) + x,
+        "centroid_y": np.array([nucleus["centroid"][1] for nucleus in nuclei], dtype=np.float32) + y,
+        "type": np.array([nucleus["type"] or 0 for nucleus in nuclei], dtype=np.int16),
+        "prob": np.array([np.nan if nucleus.get("prob") is None else nucleus["prob"] for nucleus in nuclei], dtype=np.float32),
+        "bbox": (np.asarray([nucleus["box"] for nucleus in nuclei], dtype=np.int32).reshape(-1, 4)
+                 + np.array([x, y, x, y], dtype=np.int32)),
+        "tile": np.full(len(nuclei), tile_index, dtype=np.int32),
+        "contour_lengths": np.array([len(contour) for contour in contours], dtype=np.int64),
+        "contour_points": (np.concatenate(contours).astype(np.int32) if contours
+                           else np.zeros((0, 2), dtype=np.int32)),
+    }
+
+def points_in_polygon(px, py, polygon):
+    """Even-odd test of many points against one polygon, vectorized over the points."""
+    inside = np.zeros(len(px), dtype=bool)
+    for (x0, y0), (x1, y1) in zip(polygon, polygon[1:] + polygon[:1]):
+        if y0 == y1:
+            continue
+        crosses = (y0 > py) != (y1 > py)
+        inside ^= crosses & (px < x0 + (py - y0) * (x1 - x0) / (y1 - y0))
+    return inside
+
+class NucleusStore:
+    """Slide-level columnar nucleus table, memory-mapped on read.
+
+    uploads/<id>/nuclei/ holds centroid_x, centroid_y (level 0), type, prob, bbox
+    (x0, y0, x1, y1, level 0) and tile (result manifest index) as one .npy each,
+    plus contour_offsets (N + 1) into contour_points (M x 2, level 0). meta.json
+    is written last, so a store without it is incomplete.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.columns = {name: np.load(os.path.join(store_dir, f"{name}.npy"), mmap_mode='r')
+                        for name in list(COLUMNS) + ["contour_offsets", "contour_points"]}
+
+    @staticmethod
+    def path(file_id_name):
+        return f"./uploads/{file_id_name}/nuclei/"
+
+    @staticmethod
+    def exists(store_dir):
+        return os.path.exists(os.path.join(store_dir, "meta.json"))
+
+    def __len__(self):
+        return self.meta["count"]
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def type_counts(self, selection=None):
+        """Nuclei per type, for all nuclei or a boolean selection."""
+        types = self.columns["type"] if selection is None else self.columns["type"][selection]
+        return np.bincount(types, minlength=NUM_TYPES)
+
+    def tile_counts(self, num_tiles):
+        """num_tiles x NUM_TYPES counts, row i for manifest tile i."""
+        types = self.columns["type"]
+        #an out of range type would spill into the next tile's row
+        known = (types >= 0) & (types < NUM_TYPES)
+        keys = self.columns["tile"][known].astype(np.int64) * NUM_TYPES + types[known]
+        return np.bincount(keys, minlength=num_tiles * NUM_TYPES).reshape(num_tiles, NUM_TYPES)
+
+    def in_region(self, roi):
+        """Boolean selection of the nuclei whose centroid lies in a parsed roi."""
+        px = self.columns["centroid_x"]
+        py = self.columns["centroid_y"]
+        bx, by, bw, bh = roi["bbox"]
+        selection = (px >= bx) & (px < bx + bw) & (py >= by) & (py < by + bh)
+        if "polygon" in roi:
+            candidates = np.flatnonzero(selection)
+            polygon = [tuple(point) for point in roi["polygon"]]
+            selection[candidates] = points_in_polygon(px[candidates], py[candidates], polygon)
+        return selection
+
+class NucleusStoreWriter:
+    """Appends tiles' columns in tile order, then turns them into the .npy files of a NucleusStore."""
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        if os.path.isdir(store_dir):
+            shutil.rmtree(store_dir)
+        os.makedirs(store_dir)
+        self.files = {name: open(self.raw_path(name), 'wb') for name in list(COLUMNS) + ["contour_points"]}
+        self.offsets_file = open(self.raw_path("contour_offsets"), 'wb')
+        self.offsets_file.write(np.zeros(1, dtype=np.int64).tobytes())
+        self.count = 0
+        self.num_points = 0
+
+    def raw_path(self, name):
+        return os.path.join(self.store_dir, f"{name}.bin")
+
+    def append(self, columns):
+        for name, f in self.files.items():
+            f.write(np.ascontiguousarray(columns[name]).tobytes())
+        offsets = self.num_points + np.cumsum(columns["contour_lengths"])
+        self.offsets_file.write(offsets.astype(np.int64).tobytes())
+        self.count += len(columns["type"])
+        self.num_points += int(columns["contour_lengths"].sum())
+
+    def close(self):
+        dtypes = dict(COLUMNS, contour_points=(np.int32, (2,)), contour_offsets=(np.int64, ()))
+        for f in list(self.files.values()) + [self.offsets_file]:
+            f.close()
+
+        for name, (dtype, row_shape) in dtypes.items():
+            raw = np.fromfile(self.raw_path(name), dtype=dtype).reshape((-1,) + row_shape)
+            np.save(os.path.join(self.store_dir, f"{name}.npy"), raw)
+            os.remove(self.raw_path(name))
+
+        with atomic_write(os.path.join(self.store_dir, "meta.json")) as tmp_path:
+            with open(tmp_path, 'w') as f:
+                json.dump({"count": self.count, "num_points": self.num_points, "num_types": NUM_TYPES}, f)
+        return NucleusStore(self.store_dir)
+
+    def abort(self):
+        """Close the files and remove the partial store."""
+        for f in list(self.files.values()) + [self.offsets_file]:
+            f.close()
+        shutil.rmtree(self.store_dir, ignore_errors=True)
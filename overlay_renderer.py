@@ -0,0 +1,59 @@
+import os
+import time
+import cv2
+import numpy as np
+from image_encoders import encoder_for, encode_stats
+
+TYPE_COLOURS = {
+    0: ("Background", (255, 255, 255, 0)), #transparent
+    1: ("Epithelial", (255, 0, 0)),
+    2: ("Lymphocyte", (255, 255, 0)),
+    3: ("Macrophage", (0, 255, 0)),
+    4: ("Neutrophil", (0, 0, 255)),
+}
+LINE_THICKNESS = 4
+
+
+def render_overlay(tile_img, tile_preds, scale=1.0, line_thickness=LINE_THICKNESS, type_colours=TYPE_COLOURS):
+    """BGR overlay of the nucleus contours on a tile, ready for cv2.imwrite.
+
+    Contours are grouped by type and each type is drawn with one polylines call.
+    With scale < 1 the tile is shrunk first and the contours and line width are
+    scaled with it, so the full resolution overlay is never built. Types whose
+    colour has zero alpha are not drawn.
+    """
+    canvas = cv2.cvtColor(np.ascontiguousarray(tile_img[..., :3]), cv2.COLOR_RGB2BGR)
+    if scale != 1.0:
+        canvas = cv2.resize(canvas, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    thickness = max(1, int(round(line_thickness * scale)))
+
+    contours_by_type = {}
+    for nucleus in tile_preds.values():
+        contours_by_type.setdefault(nucleus["type"], []).append(nucleus["contour"])
+
+    for type_id, contours in contours_by_type.items():
+        colour = type_colours.get(type_id, ("Unknown", (255, 255, 255)))[1]
+        if len(colour) == 4 and colour[3] == 0:
+            continue
+        points = [np.round(np.asarray(contour, dtype=np.float32).reshape(-1, 1, 2) * scale).astype(np.int32)
+                  for contour in contours]
+        cv2.polylines(canvas, points, isClosed=True, color=tuple(int(c) for c in colour[2::-1]), thickness=thickness)
+
+    return canvas
+
+def cv2_params(encoder):
+    if encoder.format == "png":
+        return [cv2.IMWRITE_PNG_COMPRESSION, encoder.level]
+    if encoder.format == "webp":
+        #opencv switches to lossless webp above quality 100
+        return [cv2.IMWRITE_WEBP_QUALITY, 101 if encoder.lossless else encoder.level]
+    return [cv2.IMWRITE_JPEG_QUALITY, encoder.level]
+
+def write_overlay(overlay_path, overlay, encoder=None):
+    """Encode a BGR overlay with the overlay encoder (ENCODE_OVERLAY) and record the bytes and time."""
+    encoder = encoder or encoder_for("overlay")
+    start = time.time()
+    written = cv2.imwrite(overlay_path, overlay, cv2_params(encoder))
+    if written:
+        encode_stats.record("overlay", os.path.getsize(overlay_path), time.time() - start)
+    return written
@@ -1,18 +1,28 @@
-import tifffile
-from PIL import Image
 import numpy as np
 import os, time, csv, logging, sys
+import argparse
+import multiprocessing
+import queue
+import shutil
+import threading
+from functools import partial
 from logging.handlers import RotatingFileHandler
 from datetime import datetime
 from time import sleep
-from PIL import Image
 #import matplotlib as mpl
 #import matplotlib.pyplot as plt
-from openslide import OpenSlide
-from tiatoolbox import data
-from tiatoolbox.tools import stainnorm
 from tiatoolbox.wsicore.wsireader import WSIReader
 from tiatoolbox.wsicore import wsireader
+from slide_utils import (open_slide, read_slide, read_thumbnail, build_tissue_mask,
+                         tile_has_tissue, synthesize_background, tissue_mask_path, save_tissue_mask,
+                         parse_roi, tile_in_roi, save_roi)
+from slide_manifest import SlideManifest
+from patch_store import PatchStore
+from image_encoders import encoder_for, encoded_complete, write_rgb, encode_stats
+from stain_utils import get_stain_normalizer, load_target_stain_model, SlideStainNormalizer
+
+#patch file format, ENCODE_PATCH
+PATCH_ENCODER = encoder_for("patch")
 
 log_directory = "/app/uploads/logs"
 os.makedirs(log_directory, exist_ok=True)
@@ -29,68 +39,387 @@ logging.basicConfig(level=logging.INFO,
                     ])
 
 
-def main(file_path):
+#function to read a run of neighbouring level-0 patches, as one strip when there is more than one
+def read_run(image_data, if_openslide, xs, y, patch_size):
+    """Yield (x, slide_patch, has_tissue, patch_std, None) for each tile of the run.
+
+    A strip is split into per-tile views without copying and the blank test std
+    is computed for the whole strip at once. Single tiles keep the plain read,
+    with patch_std left for save_patch to compute.
+    """
+    if len(xs) > 1:
+        try:
+            strip = read_slide(image_data, xs[0], y, len(xs) * patch_size, patch_size, if_openslide)
+        except Exception as e:
+            logging.error(f"Error reading strip at {xs[0]},{y}, falling back to single tiles: {e}")
+            strip = None
+
+        if strip is not None:
+            pixel_std = np.std(strip, axis=-1)
+            full_tiles = min(len(xs), strip.shape[1] // patch_size)
+            full_width = full_tiles * patch_size
+
+            #(height, n, patch_size, 3) -> (n, height, patch_size, 3), still a view into the strip
+            tiles = list(strip[:, :full_width].reshape(strip.shape[0], full_tiles, patch_size, 3).swapaxes(0, 1))
+            stds = list(pixel_std[:, :full_width].reshape(strip.shape[0], full_tiles, patch_size).mean(axis=(0, 2)))
+            #tifffile crops the last tile at the slide edge, it stays a narrower tile as before
+            if full_tiles < len(xs):
+                tiles.append(strip[:, full_width:])
+                stds.append(pixel_std[:, full_width:].mean())
+
+            for x, slide_patch, patch_std in zip(xs, tiles, stds):
+                yield x, slide_patch, True, patch_std, None
+            return
+
+    for x in xs:
+        try:
+            slide_patch = read_slide(image_data, x, y, patch_size, patch_size, if_openslide)
+        except Exception as e:
+            logging.error(f"Error processing patch at {x},{y}: {e}")
+            continue
+        yield x, slide_patch, True, None, None
+
+#function to read one grid row, tiles outside the tissue mask are filled from the thumbnail instead
+#(or not filled at all when blank tiles are not written)
+def read_patch_row(image_data, if_openslide, y, img_width, patch_size, tissue=None, write_blank=True, strip_tiles=1, completed=None, roi=None):
+    """Yield (x, slide_patch, has_tissue, patch_std, resumed_type) for every grid cell of the row.
+
+    Cells already completed by an earlier run are not read, they come back with
+    slide_patch None and resumed_type set to their recorded type. Cells outside
+    the ROI are left out entirely.
+    """
+    run = []
+    for x in range(0, img_width, patch_size):
+        if not tile_in_roi(roi, x, y, patch_size, patch_size):
+            yield from read_run(image_data, if_openslide, run, y, patch_size)
+            run = []
+            continue
+
+        has_tissue = tissue is None or tile_has_tissue(tissue[0], tissue[2], tissue[3], x, y, patch_size, patch_size)
+        resumed_type = completed.get((x, y)) if completed else None
+        if has_tissue and resumed_type is None:
+            run.append(x)
+            if len(run) >= strip_tiles:
+                yield from read_run(image_data, if_openslide, run, y, patch_size)
+                run = []
+            continue
+
+        yield from read_run(image_data, if_openslide, run, y, patch_size)
+        run = []
+
+        if resumed_type is not None:
+            yield x, None, has_tissue, None, resumed_type
+            continue
+
+        mask, thumbnail, slide_width, slide_height = tissue
+        slide_patch = None
+        if write_blank:
+            slide_patch = synthesize_background(thumbnail, slide_width, slide_height, x, y, patch_size, patch_size, if_openslide)
+        yield x, slide_patch, False, None, None
+
+    yield from read_run(image_data, if_openslide, run, y, patch_size)
+
+def load_completed_tiles(csv_file_path, img_width, img_height, file_id_name, output_dir_blank, output_dir_cell, store, write_blank):
+    """(x, y) -> type for tiles recorded by an earlier run whose output is complete.
+
+    Rows are only trusted when the csv was made for the same slide size. Pngs must
+    end with IEND, store tiles must have their slot flagged as written (store is
+    None in png mode, never the png files then), and blank tiles need no file when
+    blanks are not written.
+    """
+    completed = {}
+    if not os.path.exists(csv_file_path):
+        return completed
+
+    with open(csv_file_path, newline='') as file:
+        rows = list(csv.reader(file))
+    if not rows or rows[0][:3] != ["Lvl0:", str(img_width), str(img_height)]:
+        logging.warning(f"Not resuming, {csv_file_path} does not match the slide dimensions")
+        return completed
+
+    for row in rows[2:]:
+        #the last row may be cut short if the previous run was killed mid-write
+        if len(row) != 4 or row[3] not in ("cell", "blank"):
+            continue
+        try:
+            x, y = int(row[1]), int(row[2])
+        except ValueError:
+            continue
+        patch_type = row[3]
+
+        if patch_type == "blank" and not write_blank:
+            complete = True
+        elif store is not None:
+            #a new or rebuilt store has no slot flagged, so nothing resumes from it
+            complete = store.is_written(x, y)
+        else:
+            output_dir = output_dir_cell if patch_type == "cell" else output_dir_blank
+            complete = encoded_complete(os.path.join(output_dir, f"{file_id_name}_{x}_{y}.{PATCH_ENCODER.extension}"))
+
+        if complete:
+            completed[(x, y)] = patch_type
+    return completed
+
+#function to select and normalize a single patch, returns the patch and its type
+def normalize_patch(slide_patch, stain_normalizer, threshold_std, has_tissue=True, patch_std=None):
+    if has_tissue and patch_std is None:
+        patch_std = np.mean(np.std(slide_patch, axis=-1))
+
+    #selecting patches
+    if has_tissue and patch_std > threshold_std:
+        # Apply normalization on cell image
+        return stain_normalizer.transform(slide_patch.copy()), "cell"
+    return slide_patch, "blank"
+
+#function to write a selected patch as an image file or into the patch store
+def write_patch(slide_patch, x, y, patch_type, file_id_name, output_dir_blank, output_dir_cell, store=None, write_blank=True):
+    #merge synthesizes the background, so the blank tile is only recorded in the csv
+    if patch_type == "blank" and not write_blank:
+        return
+
+    if store is not None:
+        store.write(x, y, slide_patch)
+    else:
+        output_dir = output_dir_cell if patch_type == "cell" else output_dir_blank
+        write_rgb(os.path.join(output_dir, f"{file_id_name}_{x}_{y}.{PATCH_ENCODER.extension}"), slide_patch, PATCH_ENCODER, "patch")
+
+#function to select, normalize and save a single patch, returns the patch type
+def save_patch(slide_patch, x, y, file_id_name, stain_normalizer, output_dir_blank, output_dir_cell, threshold_std, has_tissue=True, store=None, write_blank=True, patch_std=None):
+    slide_patch, patch_type = normalize_patch(slide_patch, stain_normalizer, threshold_std, has_tissue, patch_std)
+    write_patch(slide_patch, x, y, patch_type, file_id_name, output_dir_blank, output_dir_cell, store, write_blank)
+    return patch_type
+
+#bounded queues between pipeline stages, caps the number of tiles held in memory
+PIPELINE_QUEUE_SIZE = 16
+
+class StageStats:
+    """Tiles handled and busy seconds per pipeline stage, summed over the stage's threads."""
+
+    def __init__(self, stages):
+        self.lock = threading.Lock()
+        self.stats = {stage: [0, 0.0] for stage in stages}
+
+    def record(self, stage, seconds):
+        with self.lock:
+            self.stats[stage][0] += 1
+            self.stats[stage][1] += seconds
+
+    def summary(self, wall_seconds):
+        lines = []
+        for stage, (count, busy) in self.stats.items():
+            rate = count / busy if busy > 0 else 0.0
+            lines.append(f"Stage {stage}: {count} tiles, {busy:.1f}s busy, {rate:.1f} tiles/s per thread, "
+                         f"{count / max(wall_seconds, 1e-9):.1f} tiles/s overall")
+        return lines
+
+def run_pipeline(image_data, if_openslide, img_width, img_height, patch_size, tissue, write_blank, strip_tiles,
+                 stain_normalizer, threshold_std, file_id_name, output_dir_blank, output_dir_cell, store,
+                 stats, normalize_threads=2, encode_threads=2, completed=None, roi=None):
+    """Read -> normalize -> encode/write pipeline for one slide, in a single process.
+
+    A reader thread prefetches regions, normalize and encode threads work from
+    bounded queues so a slow stage applies backpressure to the ones before it.
+    Yields (x, y, patch_type, has_tissue) in raster order, patch_type is None
+    when the tile failed after it was read.
+    """
+    read_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    encode_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    result_queue = queue.Queue()
+    reader_error = []
+    normalizers_left = [normalize_threads]
+    normalizers_lock = threading.Lock()
+
+    def reader():
+        seq = 0
+        try:
+            for y in range(0, img_height, patch_size):
+                patches = read_patch_row(image_data, if_openslide, y, img_width, patch_size, tissue, write_blank, strip_tiles,
+                                         completed, roi)
+                while True:
+                    start = time.time()
+                    try:
+                        x, slide_patch, has_tissue, patch_std, resumed_type = next(patches)
+                    except StopIteration:
+                        break
+                    if resumed_type is None:
+                        stats.record("read", time.time() - start)
+                    read_queue.put((seq, x, y, slide_patch, has_tissue, patch_std, resumed_type))
+                    seq += 1
+        except Exception as e:
+            reader_error.append(e)
+        finally:
+            for _ in range(normalize_threads):
+                read_queue.put(None)
+
+    def normalizer():
+        while True:
+            item = read_queue.get()
+            if item is None:
+                break
+            seq, x, y, slide_patch, has_tissue, patch_std, resumed_type = item
+            if resumed_type is not None:
+                encode_queue.put((seq, x, y, None, resumed_type, has_tissue, True))
+                continue
+            start = time.time()
+            try:
+                slide_patch, patch_type = normalize_patch(slide_patch, stain_normalizer, threshold_std, has_tissue, patch_std)
+            except Exception as e:
+                logging.error(f"Error processing patch at {x},{y}: {e}")
+                slide_patch, patch_type = None, None
+            stats.record("normalize", time.time() - start)
+            encode_queue.put((seq, x, y, slide_patch, patch_type, has_tissue, False))
+
+        #the last normalizer out tells every encoder to stop
+        with normalizers_lock:
+            normalizers_left[0] -= 1
+            if normalizers_left[0] == 0:
+                for _ in range(encode_threads):
+                    encode_queue.put(None)
+
+    def encoder():
+        while True:
+            item = encode_queue.get()
+            if item is None:
+                result_queue.put(None)
+                break
+            seq, x, y, slide_patch, patch_type, has_tissue, resumed = item
+            if patch_type is not None and not resumed:
+                start = time.time()
+                try:
+                    write_patch(slide_patch, x, y, patch_type, file_id_name, output_dir_blank, output_dir_cell, store, write_blank)
+                except Exception as e:
+                    logging.error(f"Error processing patch at {x},{y}: {e}")
+                    patch_type = None
+                stats.record("encode", time.time() - start)
+            result_queue.put((seq, x, y, patch_type, has_tissue))
+
+    threads = [threading.Thread(target=reader, daemon=True)]
+    threads += [threading.Thread(target=normalizer, daemon=True) for _ in range(normalize_threads)]
+    threads += [threading.Thread(target=encoder, daemon=True) for _ in range(encode_threads)]
+    for thread in threads:
+        thread.start()
+
+    #results finish out of order, release them in raster order
+    pending = {}
+    next_seq = 0
+    encoders_left = encode_threads
+    while encoders_left:
+        item = result_queue.get()
+        if item is None:
+            encoders_left -= 1
+            continue
+        pending[item[0]] = item[1:]
+        while next_seq in pending:
+            yield pending.pop(next_seq)
+            next_seq += 1
+
+    for thread in threads:
+        thread.join()
+    if reader_error:
+        raise reader_error[0]
+
+#per-worker state, set once by init_worker in each pool process
+worker_state = {}
+
+def init_worker(file_path, file_id_name, output_dir_blank, output_dir_cell, patch_size, threshold_std, tissue=None, stain_normalizer=None, store_dir=None, write_blank=True, strip_tiles=1, completed=None, roi=None):
+    """Open a private slide handle and load the stain normalizer once per worker process."""
+    slide, if_openslide = open_slide(file_path)
+    worker_state.update({
+        "slide": slide,
+        "if_openslide": if_openslide,
+        "tissue": tissue,
+        "stain_normalizer": stain_normalizer or get_stain_normalizer(),
+        "file_id_name": file_id_name,
+        "output_dir_blank": output_dir_blank,
+        "output_dir_cell": output_dir_cell,
+        "patch_size": patch_size,
+        "threshold_std": threshold_std,
+        "store": PatchStore(store_dir, file_id_name, mode='r+') if store_dir else None,
+        "write_blank": write_blank,
+        "strip_tiles": strip_tiles,
+        "completed": completed,
+        "roi": roi,
+    })
+
+def process_row(y, img_width):
+    """Patch one row band of the grid in a worker, returns (y, [(x, type, has_tissue), ...], encode stats)."""
+    state = worker_state
+    results = []
+    patches = read_patch_row(state["slide"], state["if_openslide"], y, img_width, state["patch_size"], state["tissue"],
+                             state["write_blank"], state["strip_tiles"], state["completed"], state["roi"])
+    for x, slide_patch, has_tissue, patch_std, resumed_type in patches:
+        try:
+            patch_type = resumed_type or save_patch(slide_patch, x, y, state["file_id_name"], state["stain_normalizer"],
+                                    state["output_dir_blank"], state["output_dir_cell"], state["threshold_std"], has_tissue,
+                                    state["store"], state["write_blank"], patch_std)
+            results.append((x, patch_type, has_tissue))
+        except Exception as e:
+            logging.error(f"Error processing patch at {x},{y}: {e}")
+            continue
+    #encode stats live in the worker, the parent adds them up
+    return y, results, encode_stats.take()
+
+def main(file_path, workers=1, use_tissue_mask=True, stain_mode="tile", patch_store="png", write_blank=True, strip_tiles=1,
+         pipeline=False, normalize_threads=2, encode_threads=2, resume=False, roi=None):
     try:
         #file_path = os.path.join(folder_path, f"{file_id}.bif")
 
         #print(f"Processing file: {file_path}")
-        norm_method = "Vaha"
-        filename = os.path.basename(file_path)
-        file_id = os.path.splitext(filename)[0]
-        file_id_name = f"{file_id}_{norm_method}"
+        #dimensions and output names from the header probe made at upload
+        slide_manifest = SlideManifest.load(file_path)
+        #an roi run gets its own tagged output directory and csv names
+        roi = parse_roi(roi, slide_manifest.dimensions)
+        file_id_name = slide_manifest.file_id_name(roi)
         output_dir_blank = os.path.join(f"/app/uploads/{file_id_name}/blank/") #need to change this
         output_dir_cell = os.path.join(f"/app/uploads/{file_id_name}/cell/")
+        mask_file_path = tissue_mask_path(f"/app/uploads/{file_id_name}/", file_id_name)
         csv_file_path = os.path.join(f"/app/uploads/{file_id_name}/patches_info_{file_id_name}.csv")
-        patch_size = 1024
+        store_dir = f"/app/uploads/{file_id_name}/"
+        patch_size = slide_manifest.tile_size
         threshold_std = 5
 
+        #blank pngs of an earlier run that wrote them would be merged over the synthesized background
+        if not write_blank:
+            shutil.rmtree(output_dir_blank, ignore_errors=True)
+
         #create directories if not exist
         os.makedirs(output_dir_blank, exist_ok=True)
         os.makedirs(output_dir_cell, exist_ok=True)
+        if roi:
+            save_roi(roi, store_dir)
+            print(f"Region of interest {file_id_name}: bbox {roi['bbox']}")
 
         #initialize counters
-        level=0
         total_patches = 0
         patches_with_cells = 0
         patches_without_cells = 0
+        patches_skipped = 0
+        #(x, y, type) of every recorded patch, in csv order, for the patch store index
+        written_tiles = []
 
         #print initial progress
         print(f"progress: 0.0%")
         sys.stdout.flush()
 
-        #function to read slides and convert into numpy array
-        def read_slide(image_data, x, y, width, height, if_openslide = True):
-            if if_openslide:
-                region = image_data.read_region((x, y), level, (width, height))
-                region = region.convert('RGB')
-                region = np.asarray(region)
-                return region
-            else:
-                img_height, img_width, _ = image_data.shape
-                # Ensure the requested patch stays within bounds
-                width = min(width, img_width - x)  # Adjust width if it exceeds the image width
-                height = min(height, img_height - y)  # Adjust height if it exceeds the image height
-                    
-                region = image_data[y:y + height, x:x + width]
-                return np.asarray(region)
-        
-        def generate_patches(image_data, if_openslide, output_dir_blank, output_dir_cell, patch_size, threshold_std, csv_file_path, total_patches, patches_with_cells, patches_without_cells):
+        def expected_patches(img_width, img_height):
+            if roi is None:
+                return ((img_height // patch_size) + 1) * ((img_width // patch_size) + 1)
+            return max(1, sum(tile_in_roi(roi, x, y, patch_size, patch_size)
+                              for y in range(0, img_height, patch_size) for x in range(0, img_width, patch_size)))
+
+        def generate_patches(image_data, if_openslide, output_dir_blank, output_dir_cell, patch_size, threshold_std, csv_file_path, total_patches, patches_with_cells, patches_without_cells, patches_skipped, tissue, stain_normalizer):
             try:    
-                if if_openslide:
-                    img_width, img_height = image_data.level_dimensions[0]
-                else:
-                    img_height, img_width, _ = image_data.shape
+                img_width, img_height = slide_manifest.dimensions
                 print(f"Image dimensions: {img_width}x{img_height}")
                 sys.stdout.flush()
 
-                total_patches_expected = ((img_height // patch_size) + 1) * ((img_width // patch_size) + 1)
+                total_patches_expected = expected_patches(img_width, img_height)
 
                 progress_interval = max(1, int(total_patches_expected * 0.01))  # 1% intervals
 
-                #initialize stain normalization
-                target_image = data.stain_norm_target()
-                stain_normalizer = stainnorm.get_normalizer("Vahadane")
-                stain_normalizer.fit(target_image)
+                #initialize stain normalization, the target model is cached on disk
+                if stain_normalizer is None:
+                    stain_normalizer = get_stain_normalizer()
 
                 with open(csv_file_path, mode='w', newline='') as file:
                     writer = csv.writer(file)
@@ -98,108 +427,257 @@ def main(file_path):
                     writer.writerow(["No.", "X", "Y", "Type"])
 
                     for y in range(0, img_height, patch_size):
-                            for x in range(0, img_width, patch_size):
+                            # Adjust the patch size near the edges
+                            patches = read_patch_row(image_data, if_openslide, y, img_width, patch_size, tissue, write_blank, strip_tiles,
+                                                     completed, roi)
+                            for x, slide_patch, has_tissue, patch_std, resumed_type in patches:
                                 try:
-                                    # Adjust the patch size near the edges
-                                    slide_patch = read_slide(image_data, x, y, patch_size, patch_size, if_openslide)
                                     total_patches += 1
+                                    if not has_tissue:
+                                        patches_skipped += 1
 
                                     if total_patches % progress_interval == 0:
                                         #calculate progress
                                         progress = min(99.0, (total_patches / total_patches_expected) * 100)
                                         print(f"progress: {progress:.0f}%", flush=True)
-                                        #if total_patches % 10 == 0: #update progress every 50 patches
-                                         #   print(f"progress: {progress:.0f}%") 
-                                          #  sys.stdout.flush()
-
-                                    patch_std = np.mean(np.std(slide_patch, axis=-1))
-                                    patch_filename = f"{file_id_name}_{x}_{y}.png"
-
-                                    #selecting patches
-                                    if patch_std > threshold_std:
-                                        # Apply normalization on cell image
-                                        #target_image = data.stain_norm_target()
-                                        #stain_normalizer = stainnorm.get_normalizer("Vahadane")
-                                        #stain_normalizer.fit(target_image)
-
-                                        slide_patch = stain_normalizer.transform(slide_patch.copy())
-                                        patch_full_path = os.path.join(output_dir_cell, patch_filename)
+
+                                    patch_type = resumed_type or save_patch(slide_patch, x, y, file_id_name, stain_normalizer,
+                                                                            output_dir_blank, output_dir_cell, threshold_std, has_tissue, store,
+                                                                            write_blank, patch_std)
+                                    if patch_type == "cell":
                                         patches_with_cells += 1
-                                        patch_type = "cell"
                                     else:
-                                        patch_full_path = os.path.join(output_dir_blank, patch_filename)
                                         patches_without_cells += 1
-                                        patch_type = "blank"
-
-                                    Image.fromarray(slide_patch).save(patch_full_path)
-                                    #plt.imsave(patch_full_path, slide_patch)
-                                    #print(f"Saved patch {total_patches}: {patch_full_path}")
 
                                     #coordinate records
                                     writer.writerow([total_patches, x, y, patch_type])
+                                    written_tiles.append((x, y, patch_type))
                                 except Exception as e:
                                     logging.error(f"Error processing patch at {x},{y}: {e}")
                                     continue
 
-                return total_patches, patches_with_cells, patches_without_cells
+                return total_patches, patches_with_cells, patches_without_cells, patches_skipped
             except Exception as e:
                 logging.error(f"Error in generate_patches: {e}")
                 raise
-        
-        start_time = time.time()
 
-        #if openslide cannot open use tifffile
-        # Load the image using tifffile
+        def generate_patches_parallel(img_width, img_height, workers, csv_file_path, total_patches, patches_with_cells, patches_without_cells, patches_skipped, tissue, stain_normalizer):
+            """Spread row bands over a process pool, CSV rows are still written in raster order."""
+            try:
+                print(f"Image dimensions: {img_width}x{img_height}")
+                print(f"Patching with {workers} workers")
+                sys.stdout.flush()
 
-        if file_path.endswith('.svs') or file_path.endswith('.tif'):
-            slide = OpenSlide(file_path)
-            if_openslide = True
+                total_patches_expected = expected_patches(img_width, img_height)
+                row_ys = [y for y in range(0, img_height, patch_size)
+                          if roi is None or roi["bbox"][1] - patch_size < y < roi["bbox"][1] + roi["bbox"][3]]
 
-        elif file_path.endswith('.bif'):
-            with tifffile.TiffFile(file_path) as tif:
-                slide = tif.pages[2].asarray()
-                if_openslide = False
-        else:
-            raise ValueError("Unsupported file type")
+                #rows can finish out of order, keep them until every earlier row is written
+                pending_rows = {}
+                next_row = 0
+                tiles_done = 0
+                last_progress = -1
+
+                with open(csv_file_path, mode='w', newline='') as file:
+                    writer = csv.writer(file)
+                    writer.writerow(["Lvl0:", img_width, img_height])
+                    writer.writerow(["No.", "X", "Y", "Type"])
+
+                    with multiprocessing.Pool(
+                        processes=workers,
+                        initializer=init_worker,
+                        initargs=(file_path, file_id_name, output_dir_blank, output_dir_cell, patch_size, threshold_std, tissue, stain_normalizer,
+                                  store_dir if store is not None else None, write_blank, strip_tiles, completed, roi)
+                    ) as pool:
+                        row_results = pool.imap_unordered(partial(process_row, img_width=img_width), row_ys)
+
+                        for y, results, row_encode_stats in row_results:
+                            encode_stats.add(row_encode_stats)
+                            pending_rows[y] = results
+                            tiles_done += len(results)
+
+                            progress = int(min(99.0, (tiles_done / total_patches_expected) * 100))
+                            if progress > last_progress:
+                                print(f"progress: {progress:.0f}%", flush=True)
+                                last_progress = progress
+
+                            while next_row < len(row_ys) and row_ys[next_row] in pending_rows:
+                                row_y = row_ys[next_row]
+                                for x, patch_type, has_tissue in pending_rows.pop(row_y):
+                                    total_patches += 1
+                                    if not has_tissue:
+                                        patches_skipped += 1
+                                    if patch_type == "cell":
+                                        patches_with_cells += 1
+                                    else:
+                                        patches_without_cells += 1
+                                    #coordinate records
+                                    writer.writerow([total_patches, x, row_y, patch_type])
+                                    written_tiles.append((x, row_y, patch_type))
+                                next_row += 1
+
+                return total_patches, patches_with_cells, patches_without_cells, patches_skipped
+            except Exception as e:
+                logging.error(f"Error in generate_patches_parallel: {e}")
+                raise
+
+        def generate_patches_pipeline(image_data, if_openslide, csv_file_path, total_patches, patches_with_cells, patches_without_cells, patches_skipped, tissue, stain_normalizer):
+            """Single process, with reading, normalization and encoding overlapped in threads."""
+            try:
+                img_width, img_height = slide_manifest.dimensions
+                print(f"Image dimensions: {img_width}x{img_height}")
+                print(f"Patching pipeline with {normalize_threads} normalize and {encode_threads} encode threads")
+                sys.stdout.flush()
+
+                total_patches_expected = expected_patches(img_width, img_height)
+                progress_interval = max(1, int(total_patches_expected * 0.01))  # 1% intervals
+                tiles_done = 0
+
+                if stain_normalizer is None:
+                    stain_normalizer = get_stain_normalizer()
+
+                with open(csv_file_path, mode='w', newline='') as file:
+                    writer = csv.writer(file)
+                    writer.writerow(["Lvl0:", img_width, img_height])
+                    writer.writerow(["No.", "X", "Y", "Type"])
 
-        #with tifffile.TiffFile(file_path) as tif:
-            #slide = tif.pages[2].asarray()
+                    results = run_pipeline(image_data, if_openslide, img_width, img_height, patch_size, tissue, write_blank,
+                                           strip_tiles, stain_normalizer, threshold_std, file_id_name, output_dir_blank,
+                                           output_dir_cell, store, stage_stats, normalize_threads, encode_threads, completed, roi)
+                    for x, y, patch_type, has_tissue in results:
+                        tiles_done += 1
+                        if tiles_done % progress_interval == 0:
+                            progress = min(99.0, (tiles_done / total_patches_expected) * 100)
+                            print(f"progress: {progress:.0f}%", flush=True)
+
+                        if patch_type is None:
+                            continue
+                        total_patches += 1
+                        if not has_tissue:
+                            patches_skipped += 1
+                        if patch_type == "cell":
+                            patches_with_cells += 1
+                        else:
+                            patches_without_cells += 1
+
+                        #coordinate records
+                        writer.writerow([total_patches, x, y, patch_type])
+                        written_tiles.append((x, y, patch_type))
+
+                return total_patches, patches_with_cells, patches_without_cells, patches_skipped
+            except Exception as e:
+                logging.error(f"Error in generate_patches_pipeline: {e}")
+                raise
+        
+        start_time = time.time()
 
-        #generate patches and save the patches
-        total_patches, patches_with_cells, patches_without_cells = generate_patches(
-            slide, if_openslide, output_dir_blank, output_dir_cell, patch_size, threshold_std, csv_file_path,
-            total_patches, patches_with_cells, patches_without_cells)
+        #if openslide cannot open use tifffile
+        slide, if_openslide = open_slide(file_path)
+        img_width, img_height = slide_manifest.dimensions
+
+        #low resolution tissue detection, saved next to the patches csv for later stages
+        tissue = None
+        if use_tissue_mask or stain_mode == "slide":
+            thumbnail = read_thumbnail(slide, if_openslide)
+            mask = build_tissue_mask(thumbnail, threshold_std)
+        if use_tissue_mask:
+            save_tissue_mask(mask, mask_file_path)
+            tissue = (mask, thumbnail, img_width, img_height)
+            print(f"Tissue mask: {mask.mean() * 100:.1f}% of slide area")
+            sys.stdout.flush()
+
+        #optional memory-mapped patch store instead of one png per tile
+        store = None
+        store_valid = False
+        if patch_store == "npy":
+            if resume and PatchStore.exists(store_dir, file_id_name):
+                store = PatchStore(store_dir, file_id_name, mode='r+')
+                #only reuse a store laid out for this slide and grid
+                store_valid = (store.img_width, store.img_height, store.patch_size) == (img_width, img_height, patch_size)
+                if not store_valid:
+                    del store
+            if not store_valid:
+                store = PatchStore.create(store_dir, file_id_name, img_width, img_height, patch_size, crop_edges=not if_openslide,
+                                          blank_tiles_written=write_blank)
+            print(f"Patch store: {store.array_path}")
+            sys.stdout.flush()
+        else:
+            #a stale store from an earlier run would shadow the new pngs in predict and merge
+            for stale_path in PatchStore.paths(store_dir, file_id_name):
+                if os.path.exists(stale_path):
+                    os.remove(stale_path)
+
+        #tiles finished by an interrupted earlier run are kept and not read again
+        completed = {}
+        if resume:
+            completed = load_completed_tiles(csv_file_path, img_width, img_height, file_id_name, output_dir_blank,
+                                             output_dir_cell, store, write_blank)
+            if store is not None:
+                #missing blanks are redone below, so the store now matches this run's blank mode
+                store.blank_tiles_written = write_blank
+                store.meta["blank_tiles_written"] = write_blank
+            print(f"Resuming: {len(completed)} patches already complete")
+            sys.stdout.flush()
+
+        #per-slide source stains from the thumbnail, tiles then only need a colour mapping
+        stain_normalizer = None
+        if stain_mode == "slide":
+            stain_normalizer = SlideStainNormalizer.from_thumbnail(thumbnail, mask)
+            print("Stain normalization: source stains estimated once from slide thumbnail")
+            sys.stdout.flush()
+
+        stage_stats = StageStats(["read", "normalize", "encode"])
+
+        if workers > 1:
+            #workers open their own handles, the parent only needs the dimensions and mask
+            del slide
+            #fit the target model here on a cold cache so workers only ever load it
+            load_target_stain_model()
+
+            total_patches, patches_with_cells, patches_without_cells, patches_skipped = generate_patches_parallel(
+                img_width, img_height, workers, csv_file_path,
+                total_patches, patches_with_cells, patches_without_cells, patches_skipped, tissue, stain_normalizer)
+        elif pipeline:
+            total_patches, patches_with_cells, patches_without_cells, patches_skipped = generate_patches_pipeline(
+                slide, if_openslide, csv_file_path,
+                total_patches, patches_with_cells, patches_without_cells, patches_skipped, tissue, stain_normalizer)
+        else:
+            #generate patches and save the patches
+            total_patches, patches_with_cells, patches_without_cells, patches_skipped = generate_patches(
+                slide, if_openslide, output_dir_blank, output_dir_cell, patch_size, threshold_std, csv_file_path,
+                total_patches, patches_with_cells, patches_without_cells, patches_skipped, tissue, stain_normalizer)
         
+        if store is not None:
+            store.flush()
+            store.save_index(written_tiles)
+
         #final progress update
         print(f"progress: 100%")
         sys.stdout.flush()
 
-        
-
         end_time = time.time()
 
         elapsed_time = end_time - start_time
         minutes = int(elapsed_time //60)
         seconds = int(elapsed_time % 60)
-        #print(f"Elapsed time: {minutes} minutes {seconds} seconds")
-
-        # File Processed: {file_path}
-        #File Name: {file_id_name}
-        #       Elapsed time: {minutes} minutes {seconds} seconds
-
-        #summary = f"""
-        #Total patches generated: {total_patches}
-        #Patches with cells: {patches_with_cells}
-        #Patches without cells: {patches_without_cells}
-        #"""
-        #print(summary)
 
         print(f"Total patches generated: {total_patches}")
         print(f"Patches with cells: {patches_with_cells}")
         print(f"Patches without cells: {patches_without_cells}")
+        print(f"Patches skipped by tissue mask: {patches_skipped}")
+        if resume:
+            print(f"Patches resumed from previous run: {len(completed)}")
+        if not write_blank:
+            print("Blank patches recorded in csv only, merge fills the background from the slide")
+        if pipeline and workers <= 1:
+            for line in stage_stats.summary(elapsed_time):
+                print(line)
+        print(f"Patch encoder: {PATCH_ENCODER}")
+        for line in encode_stats.summary():
+            print(line)
         sys.stdout.flush()
 
-        logging.info(f"Total patches: {total_patches}, with cells: {patches_with_cells}, without cells: {patches_without_cells}")
+        logging.info(f"Total patches: {total_patches}, with cells: {patches_with_cells}, without cells: {patches_without_cells}, skipped by mask: {patches_skipped}")
         logging.info(f"Process completed in {time.time() - start_time:.2f} seconds")
 
         return True
@@ -214,9 +692,31 @@ def main(file_path):
     
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python patch.py <filepath>")
-        sys.exit(1)
-    
-    file_path = sys.argv[1]
-    main(file_path)
\ No newline at end of file
+    parser = argparse.ArgumentParser(usage="python patch.py <filepath> [--workers N] [--no-tissue-mask] [--stain-mode tile|slide] [--patch-store png|npy] [--skip-blank] [--strip-tiles N] [--pipeline] [--resume] [--roi JSON]")
+    parser.add_argument("file_path")
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("PATCH_WORKERS", 1)),
+                        help="number of patching processes (default: PATCH_WORKERS or 1)")
+    parser.add_argument("--no-tissue-mask", action="store_true",
+                        help="read every level-0 tile instead of skipping background found on the thumbnail")
+    parser.add_argument("--stain-mode", choices=["tile", "slide"], default=os.environ.get("PATCH_STAIN_MODE", "tile"),
+                        help="fit source stains per tile (default) or once per slide from the thumbnail")
+    parser.add_argument("--patch-store", choices=["png", "npy"], default=os.environ.get("PATCH_STORE", "png"),
+                        help="write one png per tile (default) or a single memory-mapped .npy patch store")
+    parser.add_argument("--skip-blank", action="store_true", default=os.environ.get("PATCH_SKIP_BLANK") == "1",
+                        help="only record blank tiles in the csv instead of saving them")
+    parser.add_argument("--strip-tiles", type=int, default=int(os.environ.get("PATCH_STRIP_TILES", 1)),
+                        help="read up to N neighbouring tissue tiles of a row in one call (default: 1, one read per tile)")
+    parser.add_argument("--pipeline", action="store_true", default=os.environ.get("PATCH_PIPELINE") == "1",
+                        help="overlap reading, normalization and encoding with threads and bounded queues")
+    parser.add_argument("--normalize-threads", type=int, default=int(os.environ.get("PATCH_NORMALIZE_THREADS", 2)))
+    parser.add_argument("--encode-threads", type=int, default=int(os.environ.get("PATCH_ENCODE_THREADS", 2)))
+    parser.add_argument("--resume", action="store_true", default=os.environ.get("PATCH_RESUME") == "1",
+                        help="keep complete patches from an interrupted run and only process the missing grid cells")
+    parser.add_argument("--roi", default=None,
+                        help='level-0 region as json, {"x", "y", "width", "height"} or {"polygon": [[x, y], ...]}')
+    args = parser.parse_args()
+
+    main(args.file_path, workers=args.workers, use_tissue_mask=not args.no_tissue_mask, stain_mode=args.stain_mode,
+         patch_store=args.patch_store, write_blank=not args.skip_blank, strip_tiles=max(1, args.strip_tiles),
+         pipeline=args.pipeline, normalize_threads=max(1, args.normalize_threads), encode_threads=max(1, args.encode_threads),
+         resume=args.resume, roi=args.roi)
@@ -0,0 +1,103 @@
+import os
+import json
+import numpy as np
+from file_utils import atomic_write
+
+
+class PatchStore:
+    """Memory-mapped patch store, one fixed-size slot per grid cell.
+
+    Tiles live in patches_<id>.npy with shape (rows * cols, patch_size, patch_size, 3),
+    created sparse so only written slots take disk space. patches_<id>.json holds the
+    slide/grid metadata and the index of written tiles as [x, y, type] in patch order.
+    patches_<id>.written.npy flags each slot once its tile is in, so a resumed run
+    can tell a written tile from a zero slot. Reads return views into the memory
+    map, no decode and no copy.
+    """
+
+    def __init__(self, store_dir, file_id_name, mode='r'):
+        self.array_path, self.index_path, self.written_path = self.paths(store_dir, file_id_name)
+        with open(self.index_path) as f:
+            self.meta = json.load(f)
+        self.patch_size = self.meta["patch_size"]
+        self.img_width = self.meta["img_width"]
+        self.img_height = self.meta["img_height"]
+        self.cols = self.meta["cols"]
+        self.crop_edges = self.meta["crop_edges"]
+        self.blank_tiles_written = self.meta.get("blank_tiles_written", True)
+        self.array = np.load(self.array_path, mmap_mode=mode)
+        self.written = np.load(self.written_path, mmap_mode=mode)
+
+    @staticmethod
+    def paths(store_dir, file_id_name):
+        return (os.path.join(store_dir, f"patches_{file_id_name}.npy"),
+                os.path.join(store_dir, f"patches_{file_id_name}.json"),
+                os.path.join(store_dir, f"patches_{file_id_name}.written.npy"))
+
+    @classmethod
+    def exists(cls, store_dir, file_id_name):
+        return all(os.path.exists(path) for path in cls.paths(store_dir, file_id_name))
+
+    @classmethod
+    def create(cls, store_dir, file_id_name, img_width, img_height, patch_size, crop_edges, blank_tiles_written=True):
+        """Allocate the store, crop_edges is True when edge tiles are smaller than patch_size (tifffile path)."""
+        array_path, index_path, written_path = cls.paths(store_dir, file_id_name)
+        cols = -(-img_width // patch_size)
+        rows = -(-img_height // patch_size)
+
+        array = np.lib.format.open_memmap(array_path, mode='w+', dtype=np.uint8,
+                                          shape=(rows * cols, patch_size, patch_size, 3))
+        del array
+        written = np.lib.format.open_memmap(written_path, mode='w+', dtype=np.uint8, shape=(rows * cols,))
+        del written
+
+        meta = {
+            "patch_size": patch_size,
+            "img_width": img_width,
+            "img_height": img_height,
+            "cols": cols,
+            "rows": rows,
+            "crop_edges": crop_edges,
+            "blank_tiles_written": blank_tiles_written,
+            "tiles": [],
+        }
+        with open(index_path, 'w') as f:
+            json.dump(meta, f)
+
+        return cls(store_dir, file_id_name, mode='r+')
+
+    def slot(self, x, y):
+        return (y // self.patch_size) * self.cols + (x // self.patch_size)
+
+    def tile_shape(self, x, y):
+        if not self.crop_edges:
+            return self.patch_size, self.patch_size
+        return min(self.patch_size, self.img_height - y), min(self.patch_size, self.img_width - x)
+
+    def write(self, x, y, tile):
+        height, width = tile.shape[:2]
+        self.array[self.slot(x, y), :height, :width] = tile[..., :3]
+        #flagged after the pixels, a slot is never marked before its tile is in
+        self.written[self.slot(x, y)] = 1
+
+    def is_written(self, x, y):
+        return bool(self.written[self.slot(x, y)])
+
+    def read(self, x, y):
+        height, width = self.tile_shape(x, y)
+        return self.array[self.slot(x, y), :height, :width]
+
+    def tiles(self, patch_type=None):
+        return [(x, y, t) for x, y, t in self.meta["tiles"] if patch_type is None or t == patch_type]
+
+    def save_index(self, tiles):
+        """Record the written tiles as (x, y, type), in patch order."""
+        self.meta["tiles"] = [[int(x), int(y), t] for x, y, t in tiles]
+        with atomic_write(self.index_path) as tmp_path:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.meta, f)
+
+    def flush(self):
+        if hasattr(self.array, "flush"):
+            self.array.flush()
+            self.written.flush()
@@ -2,20 +2,38 @@ import logging, threading
 from logging.handlers import RotatingFileHandler
 import cv2
 import joblib
-import matplotlib as mpl
-import matplotlib.pyplot as plt
 import numpy as np
+import torch
 import os, glob, time, re, sys
+import argparse
 import csv
+import json
+import multiprocessing
+from functools import partial
+import shutil
 import pyvips
 from openslide import OpenSlide
+import tiatoolbox
 from tiatoolbox import logger
 from tiatoolbox.models.engine.nucleus_instance_segmentor import NucleusInstanceSegmentor
+from tiatoolbox.models.engine.semantic_segmentor import IOSegmentorConfig, WSIStreamDataset
 from tiatoolbox.utils.misc import imread
-from tiatoolbox.utils.visualization import overlay_prediction_contours
+from tiatoolbox.wsicore.wsireader import VirtualWSIReader, WSIReader
+from tiatoolbox.wsicore.wsimeta import WSIMeta
 from natsort import natsorted
-from collections import Counter
 import traceback
+from patch_store import PatchStore
+from result_manifest import ResultManifest, DONE, COUNTED, MISSING
+from nucleus_store import NucleusStore, NucleusStoreWriter, nucleus_columns
+from overlay_renderer import render_overlay, write_overlay
+from image_encoders import encoder_for, image_extensions, encode_stats
+from result_cache import ResultCache, RESULT_CACHE_MAX_BYTES
+from slide_utils import (BifSlide, open_slide, read_slide, read_thumbnail, build_tissue_mask,
+                         tile_has_tissue, mask_window, tissue_mask_path, save_tissue_mask, load_tissue_mask,
+                         parse_roi, tile_in_roi)
+from slide_manifest import SlideManifest
+from file_utils import atomic_write
+from stain_utils import load_target_stain_model, SlideStainNormalizer
 
 log_directory = "./uploads/logs"
 os.makedirs(log_directory, exist_ok=True)
@@ -31,40 +49,413 @@ logging.basicConfig(level=logging.INFO,
                         RotatingFileHandler(log_file_path, maxBytes=10485760, backupCount=5)
                     ])
 
-def predict(file_id_name):
+#direct mode reads the slide at level 0 on the slide manifest's tile grid and the blank threshold of patch.py
+DIRECT_THRESHOLD_STD = 5
+
+GPU_BATCH_SIZE = 4
+#rough peak memory of one 256px patch through hovernet_fast at fp32, sizes the cpu batches
+CPU_BYTES_PER_PATCH = 256 * 1024 ** 2
+MAX_CPU_BATCH_SIZE = 32
+#exported onnx graphs, shared by every job through the uploads volume
+ONNX_MODEL_DIR = "./uploads/onnx_model"
+PRECISIONS = ["fp32", "onnx", "onnx-int8"]
+#torch's own thread count, restored once a cpu job is done
+DEFAULT_TORCH_THREADS = torch.get_num_threads()
+
+#per-tile results are reused across runs of the same tiles, PREDICT_CACHE=0 turns it off
+USE_RESULT_CACHE = os.environ.get("PREDICT_CACHE", "1") == "1"
+RESULT_CACHE_BYTES = int(os.environ.get("PREDICT_CACHE_MAX_BYTES", RESULT_CACHE_MAX_BYTES))
+
+#cells counting pool, tiles are handed out in chunks and each chunk returns its nucleus store columns
+COUNT_WORKERS = int(os.environ.get("PREDICT_COUNT_WORKERS", "0")) or os.cpu_count() or 1
+COUNT_CHUNK_SIZE = 16
+#overlays can be rendered below tile resolution since merge only keeps 10%, in the ENCODE_OVERLAY format
+OVERLAY_SCALE = float(os.environ.get("PREDICT_OVERLAY_SCALE", "1.0"))
+OVERLAY_ENCODER = encoder_for("overlay")
+
+def tile_reader(tile):
+    """VirtualWSIReader over an in-memory tile, with the metadata tiatoolbox gives an image file in tile mode."""
+    tile = np.asarray(tile)
+    dimensions = np.array(tile.shape[:2][::-1])
+    info = WSIMeta(mpp=np.array([1.0, 1.0]), axes="YXS", objective_power=10, slide_dimensions=dimensions,
+                   level_downsamples=[1.0], level_dimensions=[dimensions])
+    return VirtualWSIReader(tile, info=info)
+
+class BifWSIReader(WSIReader):
+    """tiatoolbox reader over BifSlide, level 0 only.
+
+    Direct mode reads .bif slides through the same tifffile page and coordinates
+    as patch.py instead of OpenSlide's ventana driver. Only baseline reads are
+    supported, which is all direct_ioconfig asks for.
+    """
+
+    def __init__(self, input_img, mpp=None, power=None):
+        super().__init__(input_img=input_img, mpp=mpp, power=power)
+        self.slide = BifSlide(str(input_img))
+
+    def _info(self):
+        height, width = self.slide.shape[:2]
+        mpp = SlideManifest.load(str(self.input_path)).meta.get("mpp_x")
+        return WSIMeta(slide_dimensions=(width, height), axes="YXS", level_dimensions=[(width, height)],
+                       level_downsamples=[1.0], level_count=1, vendor="ventana",
+                       mpp=np.array([mpp, mpp]) if mpp else None, file_path=self.input_path)
+
+    @staticmethod
+    def check_level0(resolution, units):
+        if not ((units == "level" and resolution == 0) or (units == "baseline" and resolution == 1)):
+            raise ValueError(f"BifWSIReader only reads level 0, got resolution {resolution} {units}")
+
+    def read_level0(self, x, y, width, height, pad_constant_values=0):
+        """Level-0 region padded outside the slide, BifSlide itself crops at the edge."""
+        region = np.full((height, width, 3), pad_constant_values, dtype=np.uint8)
+        slide_height, slide_width = self.slide.shape[:2]
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + width, slide_width), min(y + height, slide_height)
+        if x1 > x0 and y1 > y0:
+            region[y0 - y:y1 - y, x0 - x:x1 - x] = self.slide.read_region(x0, y0, x1 - x0, y1 - y0)[..., :3]
+        return region
+
+    def read_rect(self, location, size, resolution=0, units="level", pad_constant_values=0, **kwargs):
+        self.check_level0(resolution, units)
+        return self.read_level0(int(location[0]), int(location[1]), int(size[0]), int(size[1]), pad_constant_values)
+
+    def read_bounds(self, bounds, resolution=0, units="level", pad_constant_values=0, **kwargs):
+        self.check_level0(resolution, units)
+        start_x, start_y, end_x, end_y = (int(value) for value in bounds)
+        return self.read_level0(start_x, start_y, end_x - start_x, end_y - start_y, pad_constant_values)
+
+class TileStreamDataset(WSIStreamDataset):
+    """WSIStreamDataset that also takes in-memory tiles.
+
+    _get_reader runs inside the loader workers, where the stock one would pass
+    a patch store view to Path() and imread.
+    """
+
+    def _get_reader(self, img_path):
+        if isinstance(img_path, np.ndarray):
+            return tile_reader(img_path)
+        if self.mode == "wsi" and str(img_path).endswith(".bif"):
+            return BifWSIReader(img_path)
+        return super()._get_reader(img_path)
+
+class TileSegmentor(NucleusInstanceSegmentor):
+    """Segmentor for the patched tiles, or for the slide itself in wsi mode.
+
+    Also accepts in-memory tiles (views into the patch store, read through
+    TileStreamDataset in the loader workers), and calls
+    on_tile_done(tile_index) once each tile's result has been saved so progress
+    comes from the engine instead of watching the result directory. In wsi mode
+    on_wsi_tile_done() is called after each inference tile instead.
+    """
+
+    on_tile_done = None
+    on_wsi_tile_done = None
+
+    def _predict_one_wsi(self, wsi_idx, *args, **kwargs):
+        result = super()._predict_one_wsi(wsi_idx, *args, **kwargs)
+        if self.on_tile_done is not None:
+            self.on_tile_done(wsi_idx)
+        return result
+
+    def _infer_once(self, *args, **kwargs):
+        result = super()._infer_once(*args, **kwargs)
+        if self.on_wsi_tile_done is not None:
+            self.on_wsi_tile_done(None)
+        return result
+
+    @staticmethod
+    def get_reader(img_path, mask_path, mode, *, auto_get_mask):
+        if isinstance(img_path, np.ndarray):
+            return tile_reader(img_path), None
+        if mode == "wsi" and str(img_path).endswith(".bif"):
+            #.bif is read through BifSlide everywhere in this repo, the engine gets the same pixels as patch.py
+            reader = BifWSIReader(img_path)
+            mask_reader = None
+            if mask_path is not None:
+                mask_reader = WSIReader.open(mask_path)
+                mask_reader.info = reader.info
+            return reader, mask_reader
+        return NucleusInstanceSegmentor.get_reader(img_path, mask_path, mode, auto_get_mask=auto_get_mask)
+
+class SlideTiles:
+    """Cell tiles read straight from the slide and stain normalized on access, for direct mode."""
+
+    def __init__(self, file_path, tiles, patch_size, stain_normalizer):
+        self.file_path = file_path
+        self.tiles = tiles
+        self.patch_size = patch_size
+        self.stain_normalizer = stain_normalizer
+        self.slide = None
+
+    def __len__(self):
+        return len(self.tiles)
+
+    def __getitem__(self, index):
+        if self.slide is None:
+            self.slide, self.if_openslide = open_slide(self.file_path)
+        x, y = self.tiles[index]
+        tile = read_slide(self.slide, x, y, self.patch_size, self.patch_size, self.if_openslide)
+        return self.stain_normalizer.transform(tile)
+
+#one segmentor per process, a resident worker keeps the weights loaded between jobs
+segmentor = None
+onnx_sessions = {}
+
+def resolve_device(device="auto"):
+    if device == "auto":
+        return "cuda" if torch.cuda.is_available() else "cpu"
+    return device
+
+def available_memory():
+    """MemAvailable in bytes, free pages where /proc/meminfo is missing."""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+def cpu_batch_size():
+    """Largest batch whose activations fit in half of the available RAM."""
+    return int(max(1, min(MAX_CPU_BATCH_SIZE, available_memory() // 2 // CPU_BYTES_PER_PATCH)))
+
+def segmentor_model(inst_segmentor):
+    #predict may wrap the model in DataParallel, the hooks live on the module
+    return getattr(inst_segmentor.model, "module", inst_segmentor.model)
+
+def onnx_session(model, precision, cpu_threads):
+    """onnxruntime session for the model, exported once and int8 quantized for onnx-int8."""
+    key = (precision, cpu_threads)
+    if key in onnx_sessions:
+        return onnx_sessions[key]
+
+    try:
+        import onnxruntime
+    except ImportError as e:
+        raise RuntimeError(f"onnxruntime is required for --precision {precision}") from e
+
+    os.makedirs(ONNX_MODEL_DIR, exist_ok=True)
+    model_path = os.path.join(ONNX_MODEL_DIR, f"hovernet_fast-monusac_torch-{torch.__version__}.onnx")
+    if not os.path.exists(model_path):
+        model = model.to("cpu").eval()
+        dummy = torch.zeros(1, 3, 256, 256)
+        with torch.inference_mode():
+            output_names = list(model(dummy).keys())
+        with atomic_write(model_path) as tmp_path:
+            torch.onnx.export(model, dummy, tmp_path, input_names=["input"], output_names=output_names,
+                              dynamic_axes={name: {0: "batch"} for name in ["input"] + output_names}, opset_version=17)
+
+    if precision == "onnx-int8":
+        #onnxruntime's cpu ConvInteger only takes uint8 weights, a QInt8 graph of hovernet's convs fails to load
+        int8_path = model_path.replace(".onnx", "_quint8.onnx")
+        if not os.path.exists(int8_path):
+            from onnxruntime.quantization import quantize_dynamic, QuantType
+            with atomic_write(int8_path) as tmp_path:
+                quantize_dynamic(model_path, tmp_path, weight_type=QuantType.QUInt8)
+        model_path = int8_path
+
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = cpu_threads
+    session = onnxruntime.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+    onnx_sessions[key] = session
+    return session
+
+def softmax(x):
+    e = np.exp(x - x.max(axis=-1, keepdims=True))
+    return e / e.sum(axis=-1, keepdims=True)
+
+def onnx_infer_batch(session):
+    """Replacement for HoVerNet.infer_batch running the onnx graph, same outputs as the torch path."""
+    output_names = [output.name for output in session.get_outputs()]
+
+    def infer_batch(model, batch_data, *args, **kwargs):
+        patch_imgs = np.asarray(batch_data, dtype=np.float32).transpose(0, 3, 1, 2)
+        outputs = session.run(output_names, {"input": np.ascontiguousarray(patch_imgs)})
+        pred_dict = {name: output.transpose(0, 2, 3, 1) for name, output in zip(output_names, outputs)}
+        np_map = softmax(pred_dict["np"])[..., 1:]
+        if "tp" in pred_dict:
+            type_map = np.argmax(pred_dict["tp"], axis=-1)[..., np.newaxis].astype(np.float32)
+            return np_map, pred_dict["hv"], type_map
+        return np_map, pred_dict["hv"]
+
+    return infer_batch
+
+def reset_cpu_tuning(inst_segmentor):
+    """Undo the cpu job settings, so a later gpu job in the same worker gets torch's defaults."""
+    torch.set_num_threads(DEFAULT_TORCH_THREADS)
+    segmentor_model(inst_segmentor).to(memory_format=torch.contiguous_format)
+    inst_segmentor.batch_size = GPU_BATCH_SIZE
+
+def get_segmentor(device="cuda", precision="fp32", cpu_threads=None):
+    """hovernet_fast-monusac segmentor, built on first use and reset and tuned for each run.
+
+    On cpu the intra-op threads leave room for the loader and post-processing
+    workers, the weights use channels-last, the batch size follows the free RAM
+    and the onnx precisions swap in an onnxruntime graph.
+    """
+    global segmentor
+    if segmentor is None:
+        segmentor = TileSegmentor(
+            pretrained_model="hovernet_fast-monusac",
+            num_loader_workers=2,
+            num_postproc_workers=2,
+            batch_size=GPU_BATCH_SIZE, #reduced to 1 for sequential processing
+        )
+        #the loader workers build their own readers, in-memory tiles need the dataset to know them too
+        segmentor.dataset_class = TileStreamDataset
+    segmentor.on_tile_done = None
+    segmentor.on_wsi_tile_done = None
+    model = segmentor_model(segmentor)
+    model.preproc_func = None
+    model.__dict__.pop("infer_batch", None)
+    reset_cpu_tuning(segmentor)
+
+    if device != "cpu":
+        if precision != "fp32":
+            logging.warning(f"Precision {precision} is only used on cpu, running fp32 on {device}")
+        return segmentor
+
+    if cpu_threads is None:
+        cpu_threads = max(1, (os.cpu_count() or 1) - segmentor.num_loader_workers - segmentor.num_postproc_workers)
+    torch.set_num_threads(cpu_threads)
+    model.to(memory_format=torch.channels_last)
+    segmentor.batch_size = cpu_batch_size()
+    if precision != "fp32":
+        model.infer_batch = onnx_infer_batch(onnx_session(model, precision, cpu_threads))
+
+    logging.info(f"CPU backend: {cpu_threads} threads, batch size {segmentor.batch_size}, precision {precision}")
+    return segmentor
+
+def direct_tiles_path(file_id_name):
+    return f"./uploads/{file_id_name}/direct_tiles_{file_id_name}.json"
+
+def direct_ioconfig(tile_size):
+    """Level-0 io for hovernet_fast-monusac, the same pixels the patched pngs hold."""
+    return IOSegmentorConfig(
+        input_resolutions=[{"units": "baseline", "resolution": 1.0}],
+        output_resolutions=[{"units": "baseline", "resolution": 1.0}] * 3,
+        margin=128,
+        tile_shape=[tile_size, tile_size],
+        patch_input_shape=[256, 256],
+        patch_output_shape=[164, 164],
+        stride_shape=[164, 164],
+        save_resolution={"units": "baseline", "resolution": 1.0},
+    )
+
+def list_cell_tiles(file_id_name):
+    """Names and sources of the cell tiles, from the patch store if present, else the png directory.
+
+    Sources are file paths for pngs and zero-copy memory-map views for the store.
+    """
+    manifest_path = direct_tiles_path(file_id_name)
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        tiles = [tuple(tile) for tile in manifest["tiles"]]
+        stain_matrix_target, max_c_target = load_target_stain_model()
+        stain_normalizer = SlideStainNormalizer(np.array(manifest["stain_matrix_source"]), np.array(manifest["max_c_source"]),
+                                                stain_matrix_target, max_c_target)
+        tile_names = [f"{file_id_name}_{x}_{y}" for x, y in tiles]
+        return tile_names, SlideTiles(manifest["file_path"], tiles, manifest["patch_size"], stain_normalizer)
+
+    store_dir = f"./uploads/{file_id_name}/"
+    if PatchStore.exists(store_dir, file_id_name):
+        store = PatchStore(store_dir, file_id_name)
+        tiles = store.tiles("cell")
+        tile_names = [f"{file_id_name}_{x}_{y}" for x, y, _ in tiles]
+        tile_sources = [store.read(x, y) for x, y, _ in tiles]
+        return tile_names, tile_sources
+
+    tile_dir = f"./uploads/{file_id_name}/cell/"
+    #patches in whichever format patch.py was set to write
+    tile_paths = natsorted(path for path in glob.glob(os.path.join(tile_dir, "*.*"))
+                           if os.path.splitext(path)[1][1:] in image_extensions())
+    tile_names = [os.path.splitext(os.path.basename(path))[0] for path in tile_paths]
+    return tile_names, tile_paths
+
+def load_tile(tile_source):
+    if isinstance(tile_source, np.ndarray):
+        return np.asarray(tile_source)
+    return imread(tile_source)
+
+class TileProgress:
+    """Counts finished tiles and prints a "progress:" line every 1%."""
+
+    def __init__(self, total_tiles):
+        self.total_tiles = total_tiles
+        self.processed = 0
+        self.progress_interval = max(1, total_tiles // 100)
+        self.lock = threading.Lock()
+
+    def __call__(self, tile_index):
+        with self.lock:
+            self.processed += 1
+            processed_count = self.processed
+
+        if processed_count % self.progress_interval == 0 or processed_count == self.total_tiles:
+            progress = min(99.0, (processed_count / self.total_tiles) * 100)
+            print(f"progress: {progress:.1f}%", flush=True)
+            logging.info(f"Processed {processed_count}/{self.total_tiles} tiles ({progress:.1f}%)")
+
+def predict(file_id_name, device="auto", precision="fp32", cpu_threads=None, cell_counter=None):
     """Run the prediction for a given file_id and normalization method."""
     full_id = file_id_name
     logging.info(f"Processing file id: {full_id}")
     
-    tile_dir = f"./uploads/{full_id}/cell/"
     save_dir_base = f"./uploads/{full_id}/result/"
 
-    tile_paths = glob.glob(os.path.join(tile_dir, "*.png"))
-    tile_paths = natsorted(tile_paths)
+    #tiles come from patch.py again, forget an earlier direct run
+    if os.path.exists(direct_tiles_path(full_id)):
+        os.remove(direct_tiles_path(full_id))
+
+    tile_names, tile_paths = list_cell_tiles(full_id)
     total_tiles = len(tile_paths)
 
     if not tile_paths:
         logging.warning(f"No tiles found for file id: {full_id}")
         return
 
+    #record which result belongs to which tile before any result exists
+    if isinstance(tile_paths[0], str):
+        manifest = ResultManifest.create(full_id, tile_names, "png", tile_paths, OVERLAY_ENCODER.extension)
+    else:
+        manifest = ResultManifest.create(full_id, tile_names, "store", overlay_extension=OVERLAY_ENCODER.extension)
+
     # Record start time
     start_time = time.time()
     print(f"progress: 0.0%", flush=True)
 
-    #os.makedirs(save_dir_base, exist_ok=True)
+    #results land in result/ by manifest index, the engine writes its own numbering to result_infer/
+    if os.path.isdir(save_dir_base):
+        shutil.rmtree(save_dir_base)
+    os.makedirs(save_dir_base)
+    infer_dir = f"./uploads/{full_id}/result_infer/"
+    if os.path.isdir(infer_dir):
+        shutil.rmtree(infer_dir)
+    #cpu and cuda results can differ, the device is part of the cache key
+    device = resolve_device(device)
+    cache = ResultCache(f"hovernet_fast-monusac_tiatoolbox-{tiatoolbox.__version__}_{precision}_{device}",
+                        max_bytes=RESULT_CACHE_BYTES) if USE_RESULT_CACHE else None
+    tile_keys = {}
 
     #progress monitoring
     progress_stop_event = threading.Event()
     progress_thread = None
 
+    #tiles report themselves through the engine, polling is only a fallback for engines without the hook
+    tile_progress = TileProgress(total_tiles)
+    engine_progress = hasattr(NucleusInstanceSegmentor, "_predict_one_wsi")
+
     def monitor_progress():
         """Monitor output dir for new .dat files"""
         last_processed = 0
 
         while not progress_stop_event.is_set():
             try:
-                processed_files = glob.glob(os.path.join(save_dir_base, "*.dat"))
-                processed_count = len(processed_files)
+                processed_files = glob.glob(os.path.join(infer_dir, "*.dat"))
+                processed_count = len(processed_files) + (cache.hits if cache else 0)
 
                 if processed_count > last_processed:
                     last_processed = processed_count
@@ -88,31 +479,73 @@ def predict(file_id_name):
     
 
     try:
-        progress_thread = threading.Thread(target=monitor_progress, daemon=True)
-        progress_thread.start()
+        if not engine_progress:
+            progress_thread = threading.Thread(target=monitor_progress, daemon=True)
+            progress_thread.start()
 
-        # Initialize the segmentor
-        inst_segmentor = NucleusInstanceSegmentor(
-            pretrained_model="hovernet_fast-monusac",
-            num_loader_workers=2,
-            num_postproc_workers=2,
-            batch_size=4, #reduced to 1 for sequential processing
-        )
+        #count each tile as soon as its result is saved, the pool is forked before the model runs
+        counting = cell_counter is not None and engine_progress
+        if counting:
+            cell_counter.start(manifest)
 
-        # Perform segmentation on the tile
-        inst_segmentor.predict(
-            tile_paths,
-            save_dir=save_dir_base,
-            mode="tile",
-            device='cuda',
-            crash_on_exception=True)
+        def finish_tile(tile_index):
+            manifest.mark(tile_index, DONE)
+            tile_progress(tile_index)
+            if counting:
+                cell_counter.feed(tile_index)
+
+        #tiles seen before take their result from the cache, keyed on the stored bytes so nothing is decoded here
+        misses = []
+        hash_interval = max(1, total_tiles // 10)
+        for i in range(total_tiles):
+            if cache is None:
+                misses.append(i)
+                continue
+            tile_keys[i] = cache.key(tile_paths[i])
+            if cache.get(tile_keys[i], manifest.result_path(i)):
+                finish_tile(i)
+            else:
+                misses.append(i)
+            if (i + 1) % hash_interval == 0 or i + 1 == total_tiles:
+                print(f"Result cache lookup: {i + 1}/{total_tiles} tiles, {cache.hits} hits", flush=True)
+
+        def collect_result(miss_index):
+            #move the engine's {j}.dat to the manifest's result/{i}.dat, keep a copy in the cache
+            i = misses[miss_index]
+            os.replace(os.path.join(infer_dir, f"{miss_index}.dat"), manifest.result_path(i))
+            if cache is not None:
+                cache.put(tile_keys[i], manifest.result_path(i))
+            finish_tile(i)
+
+        if misses:
+            # Initialize the segmentor
+            inst_segmentor = get_segmentor(device, precision, cpu_threads)
+            inst_segmentor.on_tile_done = collect_result
+
+            # Perform segmentation on the tile
+            inst_segmentor.predict(
+                [tile_paths[i] for i in misses],
+                save_dir=infer_dir,
+                mode="tile",
+                device=device,
+                crash_on_exception=True)
         
         progress_stop_event.set()
 
         if progress_thread and progress_thread.is_alive():
             progress_thread.join(timeout=2)
 
-        final_processed = len(glob.glob(os.path.join(save_dir_base, "*.dat")))
+        if not engine_progress:
+            for miss_index in range(len(misses)):
+                if os.path.exists(os.path.join(infer_dir, f"{miss_index}.dat")):
+                    collect_result(miss_index)
+        manifest.save()
+
+        if cache is not None:
+            freed = cache.evict()
+            print(f"Result cache: {cache.hits} hits, {cache.misses} misses, {freed / 1024 ** 2:.1f} MB evicted", flush=True)
+
+        final_processed = len(manifest.indices(DONE, COUNTED))
         if final_processed >= total_tiles:
             print(f"progress: 100.0%", flush=True)
         
@@ -121,10 +554,15 @@ def predict(file_id_name):
         minutes = int(elapsed_time // 60)
         seconds = int(elapsed_time % 60)
         logging.info(f"Prediction time: {minutes} minutes {seconds} seconds")
+        print(f"Throughput: {total_tiles / max(elapsed_time, 1e-6):.2f} tiles/sec on {device} ({precision})", flush=True)
     
     except Exception as e:
         if progress_thread:
             progress_stop_event.set()
+        if cell_counter is not None:
+            cell_counter.abort()
+        #the tiles finished so far stay usable
+        manifest.save()
         logging.error(f"Error processing file id {full_id}: {e}")
         return None
     
@@ -132,95 +570,335 @@ def predict(file_id_name):
     logging.info(f"Finished processing file id: {full_id}")
     return True
 
-def cellsCount(file_id_name):
+def select_direct_tiles(file_path, file_id_name, roi=None, threshold_std=DIRECT_THRESHOLD_STD):
+    """Tissue tiles of the slide grid, the wsi mask limited to them, and the slide stain normalizer."""
+    slide_manifest = SlideManifest.load(file_path)
+    img_width, img_height = slide_manifest.dimensions
+    patch_size = slide_manifest.tile_size
+    slide, if_openslide = open_slide(file_path)
+    thumbnail = read_thumbnail(slide, if_openslide)
+    slide.close()
+
+    #the mask patching saved for this slide is reused, it is only built here when the slide was never patched
+    tissue = None
+    for mask_id in dict.fromkeys([file_id_name, slide_manifest.file_id_name()]):
+        saved_path = tissue_mask_path(f"./uploads/{mask_id}/", mask_id)
+        saved = load_tissue_mask(saved_path)
+        if (saved is not None and saved.shape == thumbnail.shape[:2]
+                and os.path.getmtime(saved_path) >= slide_manifest.meta["mtime"]):
+            tissue = saved
+            print(f"Tissue mask: reused {saved_path}", flush=True)
+            break
+    if tissue is None:
+        tissue = build_tissue_mask(thumbnail, threshold_std)
+        os.makedirs(f"./uploads/{file_id_name}/", exist_ok=True)
+        save_tissue_mask(tissue, tissue_mask_path(f"./uploads/{file_id_name}/", file_id_name))
+    tiles = [(x, y) for y in range(0, img_height, patch_size) for x in range(0, img_width, patch_size)
+             if tile_has_tissue(tissue, img_width, img_height, x, y, patch_size, patch_size)
+             and tile_in_roi(roi, x, y, patch_size, patch_size)]
+
+    #the engine only reads patches under the mask, so keep just the selected tiles
+    wsi_mask = np.zeros_like(tissue)
+    for x, y in tiles:
+        x0, y0, x1, y1 = mask_window(tissue, img_width, img_height, x, y, patch_size, patch_size)
+        wsi_mask[y0:y1, x0:x1] = tissue[y0:y1, x0:x1]
+    mask_path = f"./uploads/{file_id_name}/direct_mask_{file_id_name}.png"
+    save_tissue_mask(wsi_mask, mask_path)
+
+    stain_normalizer = SlideStainNormalizer.from_thumbnail(thumbnail, tissue)
+    return tiles, mask_path, stain_normalizer
+
+def split_wsi_result(wsi_preds, tiles, patch_size, result_dir):
+    """Per-tile .dat files in the tile mode layout, nuclei assigned by centroid and shifted to tile coordinates."""
+    tile_index = {tile: i for i, tile in enumerate(tiles)}
+    tile_preds = [{} for _ in tiles]
+    for inst_id, nucleus in wsi_preds.items():
+        cx, cy = nucleus["centroid"]
+        tile = (int(cx // patch_size) * patch_size, int(cy // patch_size) * patch_size)
+        i = tile_index.get(tile)
+        if i is None:
+            continue
+        offset = np.array(tile)
+        shifted = dict(nucleus)
+        shifted["centroid"] = np.asarray(nucleus["centroid"]) - offset
+        shifted["box"] = np.asarray(nucleus["box"]) - np.tile(offset, 2)
+        shifted["contour"] = np.asarray(nucleus["contour"]) - offset
+        tile_preds[i][inst_id] = shifted
+
+    if os.path.isdir(result_dir):
+        shutil.rmtree(result_dir)
+    os.makedirs(result_dir)
+    for i, preds in enumerate(tile_preds):
+        joblib.dump(preds, os.path.join(result_dir, f"{i}.dat"))
+
+def predict_direct(file_path, file_id_name, roi=None, device="auto", precision="fp32", cpu_threads=None):
+    """Run the segmentor on the slide itself in wsi mode, no patch.py output needed.
+
+    Patches are read under the tissue mask and stain normalized inside the data
+    loader, then the nuclei are split back into the 1024px tile layout so
+    cellsCount and merge work as after patching.
+    """
+    logging.info(f"Processing file id: {file_id_name} directly from {file_path}")
+    start_time = time.time()
+    print(f"progress: 0.0%", flush=True)
+
+    try:
+        tiles, mask_path, stain_normalizer = select_direct_tiles(file_path, file_id_name, roi)
+        if not tiles:
+            logging.warning(f"No tissue tiles found for file id: {file_id_name}")
+            return
+
+        #same grid as patch.py, from the slide manifest
+        patch_size = SlideManifest.load(file_path).tile_size
+        wsi_dir = f"./uploads/{file_id_name}/wsi_result/"
+        #the engine refuses an existing save_dir, the previous run's output goes first
+        if os.path.isdir(wsi_dir):
+            shutil.rmtree(wsi_dir)
+
+        device = resolve_device(device)
+        inst_segmentor = get_segmentor(device, precision, cpu_threads)
+        segmentor_model(inst_segmentor).preproc_func = stain_normalizer.transform
+        #the engine tiles on the same grid, boundary strips afterwards are held at 99%
+        inst_segmentor.on_wsi_tile_done = TileProgress(len(tiles))
+
+        inst_segmentor.predict(
+            [file_path],
+            masks=[mask_path],
+            save_dir=wsi_dir,
+            mode="wsi",
+            ioconfig=direct_ioconfig(patch_size),
+            device=device,
+            crash_on_exception=True)
+
+        wsi_preds = joblib.load(os.path.join(wsi_dir, "0.dat"))
+        split_wsi_result(wsi_preds, tiles, patch_size, f"./uploads/{file_id_name}/result/")
+        manifest = ResultManifest.create(file_id_name, [f"{file_id_name}_{x}_{y}" for x, y in tiles], "slide",
+                                          overlay_extension=OVERLAY_ENCODER.extension)
+        for i in range(len(tiles)):
+            manifest.tiles[i]["status"] = DONE
+        manifest.save()
+
+        with open(direct_tiles_path(file_id_name), 'w') as f:
+            json.dump({
+                "file_path": file_path,
+                "patch_size": patch_size,
+                "tiles": [list(tile) for tile in tiles],
+                "stain_matrix_source": stain_normalizer.stain_matrix_source.tolist(),
+                "max_c_source": stain_normalizer.max_c_source.tolist(),
+            }, f)
+
+        print(f"progress: 100.0%", flush=True)
+
+        elapsed_time = time.time() - start_time
+        minutes = int(elapsed_time // 60)
+        seconds = int(elapsed_time % 60)
+        logging.info(f"Prediction time: {minutes} minutes {seconds} seconds")
+        print(f"Throughput: {len(tiles) / max(elapsed_time, 1e-6):.2f} tiles/sec on {device} ({precision})", flush=True)
+
+    except Exception as e:
+        logging.error(f"Error processing file id {file_id_name}: {e}")
+        return None
+
+    logging.info(f"Finished processing file id: {file_id_name}")
+    return True
+
+count_state = {}
+
+def manifest_tile_sources(manifest):
+    """Tile images in manifest order: png paths, patch store views or slide reads."""
+    source = manifest.meta["source"]
+    if source == "png":
+        return [manifest.tile_path(i) for i in range(len(manifest))]
+    if source == "store":
+        store = PatchStore(ResultManifest.base_dir(manifest.file_id_name), manifest.file_id_name)
+        return [store.read(tile["x"], tile["y"]) for tile in manifest.tiles]
+    return list_cell_tiles(manifest.file_id_name)[1]
+
+def init_count_worker(file_id_name):
+    """Per-process manifest and tile sources, memory-map views and slide readers are not shared across processes."""
+    count_state["manifest"] = ResultManifest.load(file_id_name)
+    count_state["tile_sources"] = manifest_tile_sources(count_state["manifest"])
+
+def count_tile(i):
+    """Write the overlay of one tile and return its nucleus store columns, the counts are taken from the store."""
+    manifest = count_state["manifest"]
+    dat_path = manifest.result_path(i)
+
+    # Load the predictions
+    tile_preds = joblib.load(dat_path)
+    logging.info(f"Tile with dat code: {manifest.tiles[i]['name']} @ {os.path.splitext(os.path.basename(dat_path))[0]}")
+
+    # Read the corresponding tile image for visualization
+    tile_img = load_tile(count_state["tile_sources"][i])
+
+    # Create and save the overlay image
+    overlay = render_overlay(tile_img, tile_preds, scale=manifest.meta.get("overlay_scale", 1.0))
+    write_overlay(manifest.overlay_path(i), overlay, OVERLAY_ENCODER)
+
+    return nucleus_columns(tile_preds, manifest.tiles[i]["x"], manifest.tiles[i]["y"], i)
+
+def count_tiles(indices):
+    """A chunk of tiles in tile order, returns their store columns and the overlay encode stats of this process since the last chunk."""
+    columns = [count_tile(i) for i in indices]
+    return columns, encode_stats.take()
+
+def write_counts_csv(file_id_name, manifest, indices, store):
+    """Per-tile rows in tile order and the END total row, counted from the nucleus store."""
+    tile_counts = store.tile_counts(len(manifest))
+    with open(f"./uploads/{file_id_name}/nucleus_info_{file_id_name}.csv", mode='w', newline='') as file:
+        writer = csv.writer(file)
+        #type columns in type order: background, epithelial, lymphocyte, macrophage, neutrophil
+        writer.writerow(["Tile", "Dat File", "Background", "Epithelial", "Lymphocyte", "Macrophage", "Neutrophil"])
+        for i in indices:
+            dat_name = os.path.splitext(os.path.basename(manifest.result_path(i)))[0]
+            writer.writerow([manifest.tiles[i]["name"], dat_name] + tile_counts[i].tolist())
+        writer.writerow(["END", "Total"] + store.type_counts().tolist())
+
+class StreamingCellCounter:
+    """Counts cells and renders overlays while inference is still running.
+
+    feed(i) is called as soon as result/{i}.dat is saved and sends the tile to the
+    counting pool. Columns go to the nucleus store in tile order as they come
+    back, and finish() writes the csv from the store once the last tile is in.
+    """
+
+    def __init__(self, file_id_name, workers=COUNT_WORKERS):
+        self.file_id_name = file_id_name
+        self.workers = workers
+        self.started = False
+
+    def start(self, manifest):
+        self.manifest = manifest
+        self.total_tiles = len(manifest)
+        os.makedirs(f"./uploads/{self.file_id_name}/overlay/", exist_ok=True)
+        #workers read the overlay scale from the saved manifest
+        manifest.meta["overlay_scale"] = OVERLAY_SCALE
+        manifest.save()
+
+        self.store_writer = NucleusStoreWriter(NucleusStore.path(self.file_id_name))
+        self.pending = {}
+        self.next_index = 0
+        self.errors = []
+        self.lock = threading.Lock()
+        self.pool = multiprocessing.Pool(max(1, min(self.workers, self.total_tiles)), initializer=init_count_worker,
+                                         initargs=(self.file_id_name,))
+        self.start_time = time.time()
+        self.started = True
+
+    def feed(self, tile_index):
+        self.pool.apply_async(count_tiles, ([tile_index],), callback=partial(self.on_counted, tile_index),
+                              error_callback=self.errors.append)
+
+    def on_counted(self, tile_index, result):
+        #results arrive in completion order, rows are released in tile order
+        with self.lock:
+            self.pending[tile_index] = result
+            while self.next_index in self.pending:
+                columns, tile_encode_stats = self.pending.pop(self.next_index)
+                self.store_writer.append(columns[0])
+                encode_stats.add(tile_encode_stats)
+                self.manifest.mark(self.next_index, COUNTED)
+                self.next_index += 1
+
+    def finish(self):
+        """Wait for the tiles still being counted, then close the store and write the csv from it."""
+        self.pool.close()
+        self.pool.join()
+        try:
+            if self.errors:
+                raise self.errors[0]
+            if self.next_index < self.total_tiles:
+                raise RuntimeError(f"Only {self.next_index}/{self.total_tiles} tiles were counted")
+            store = self.store_writer.close()
+            write_counts_csv(self.file_id_name, self.manifest, range(self.total_tiles), store)
+        except Exception:
+            #a half written store must not be read as this run's result
+            self.store_writer.abort()
+            raise
+        finally:
+            self.started = False
+            self.manifest.save()
+
+        elapsed_time = time.time() - self.start_time
+        minutes = int(elapsed_time //60)
+        seconds = int(elapsed_time % 60)
+        print(f"Elapsed time for counting cells alongside prediction: {minutes} minutes {seconds} seconds")
+        for line in encode_stats.summary():
+            print(line)
+
+    def abort(self):
+        if self.started:
+            self.pool.terminate()
+            self.store_writer.abort()
+            self.started = False
+
+def cellsCount(file_id_name, workers=COUNT_WORKERS):
     try:
         print("Counting cells started...")
         ## Overlay image making
         # Load each .dat file collect class count and overlay the image 
-        dat_dir = f"./uploads/{file_id_name}/result/"  # Directory containing the .dat files
         overlaid_dir = f"./uploads/{file_id_name}/overlay/" 
 
         os.makedirs(overlaid_dir, exist_ok=True)
-        dat_paths = natsorted(glob.glob(os.path.join(dat_dir, "*.dat")))
 
-        tile_dir = f"./uploads/{file_id_name}/cell/"
-        csv_file_path = f"./uploads/{file_id_name}/nucleus_info_{file_id_name}.csv"  # Path for the CSV file
+        #results from before the manifest existed, tile i of the prediction input saved {i}.dat
+        manifest = ResultManifest.load(file_id_name)
+        if manifest is None:
+            tile_names, tile_paths = list_cell_tiles(file_id_name)
+            source = "png" if tile_names and isinstance(tile_paths[0], str) else "store"
+            manifest = ResultManifest.create(file_id_name, tile_names, source, tile_paths if source == "png" else None,
+                                             OVERLAY_ENCODER.extension)
+            for i in range(len(manifest)):
+                if os.path.exists(manifest.result_path(i)):
+                    manifest.tiles[i]["status"] = DONE
 
-        tile_paths = glob.glob(os.path.join(tile_dir, "*.png"))
-        sorted_tile_paths = natsorted(tile_paths)
-        tile_paths = sorted_tile_paths
+        #every tile with a result is counted, a missing result is reported instead of shifting the pairing
+        indices = []
+        for i in range(len(manifest)):
+            if manifest.status(i) not in (DONE, COUNTED):
+                continue
+            if os.path.exists(manifest.result_path(i)):
+                indices.append(i)
+            else:
+                manifest.tiles[i]["status"] = MISSING
+                logging.warning(f"Result missing for tile {manifest.tiles[i]['name']}: {manifest.tiles[i]['result']}")
+        manifest.meta["overlay_scale"] = OVERLAY_SCALE
+        manifest.save()
 
         start_time = time.time()
 
-        total_counts = Counter()
+        #chunks keep tile order, imap hands them back in order so the store stays in tile order
+        chunks = [indices[i:i + COUNT_CHUNK_SIZE] for i in range(0, len(indices), COUNT_CHUNK_SIZE)]
 
-        ## Open CSV file to record nucleus counts
-        with open(csv_file_path, mode='w', newline='') as file:
-            writer = csv.writer(file)
-            writer.writerow(["Tile", "Dat File", "Background", "Epithelial", "Lymphocyte", "Macrophage", "Neutrophil"])
-            
-            # Loop through all .dat files in the directory
-            for i in range(len(tile_paths)):
-                # Load the predictions
-                tile_preds = joblib.load(dat_paths[i])
-                tile_name = os.path.splitext(os.path.basename(tile_paths[i]))[0]
-                dat_name = os.path.splitext(os.path.basename(dat_paths[i]))[0]
-                #logging.info(f"Tile with dat code: ", tile_name, "@", dat_name)
-                logging.info(f"Tile with dat code: {tile_name} @ {dat_name}")
-
-                # Count occurrences of each cell type
-                class_counts = Counter()
-                for nucleus in tile_preds.values():
-                    class_id = nucleus["type"]
-                    class_counts[class_id] += 1
-
-                # Update the total counts with the current tile's counts            
-                total_counts.update(class_counts)         
-                    
-                # Record counts in CSV
-                writer.writerow([
-                    tile_name,
-                    dat_name,
-                    class_counts.get(0, 0),  #background
-                    class_counts.get(1, 0),  # Epithelial
-                    class_counts.get(2, 0),  # Lymphocyte
-                    class_counts.get(3, 0),  # Macrophage
-                    class_counts.get(4, 0),  # Neutrophil
-                
-                ])
-                    
-                # Read the corresponding tile image for visualization
-                tile_img = imread(tile_paths[i])
-
-                # Create the overlay image
-                overlaid_predictions = overlay_prediction_contours(
-                    canvas=tile_img,
-                    inst_dict=tile_preds,
-                    draw_dot=False,
-                    type_colours={
-                        0: ("Background", (255, 255, 255, 0)), #transparent
-                        1: ("Epithelial", (255, 0, 0)),
-                        2: ("Lymphocyte", (255, 255, 0)),
-                        3: ("Macrophage", (0, 255, 0)),
-                        4: ("Neutrophil", (0, 0, 255)),
-                    },
-                    line_thickness=4,    
-                )
-                        
-                # Save the overlaid image
-                overlay_path = f"./uploads/{file_id_name}/overlay/overlay_{tile_name}.png"
-                plt.imsave(overlay_path, overlaid_predictions)
-            
-                # After all tiles are processed, write the total counts to the CSV
-            writer.writerow([
-                "END",
-                "Total",
-                total_counts.get(0, 0), #total background
-                total_counts.get(1, 0),  # Total Epithelial
-                total_counts.get(2, 0),  # Total Lymphocyte
-                total_counts.get(3, 0),  # Total Macrophage
-                total_counts.get(4, 0),  # Total Neutrophil
-            ])   
+        #slide-level columnar copy of the results, the csv counts are taken from it
+        store_writer = NucleusStoreWriter(NucleusStore.path(file_id_name))
+        try:
+            if workers > 1 and len(chunks) > 1:
+                with multiprocessing.Pool(min(workers, len(chunks)), initializer=init_count_worker,
+                                          initargs=(file_id_name,)) as pool:
+                    for chunk, (columns, chunk_encode_stats) in zip(chunks, pool.imap(count_tiles, chunks)):
+                        encode_stats.add(chunk_encode_stats)
+                        for tile_columns in columns:
+                            store_writer.append(tile_columns)
+                        for i in chunk:
+                            manifest.mark(i, COUNTED)
+            else:
+                init_count_worker(file_id_name)
+                for chunk in chunks:
+                    columns, chunk_encode_stats = count_tiles(chunk)
+                    encode_stats.add(chunk_encode_stats)
+                    for tile_columns in columns:
+                        store_writer.append(tile_columns)
+                    for i in chunk:
+                        manifest.mark(i, COUNTED)
+
+            store = store_writer.close()
+            write_counts_csv(file_id_name, manifest, indices, store)
+        except Exception:
+            #a half written store must not be read as this run's result
+            store_writer.abort()
+            raise
+        manifest.save()
 
         print(f"progress: 100.0%", flush=True)
 
@@ -229,6 +907,8 @@ def cellsCount(file_id_name):
         minutes = int(elapsed_time //60)
         seconds = int(elapsed_time % 60)
         print(f"Elapsed time for counting cells: {minutes} minutes {seconds} seconds")
+        for line in encode_stats.summary():
+            print(line)
 
     except Exception as e:
         print(f"Error in cellsCount: {str(e)}")
@@ -238,11 +918,46 @@ def cellsCount(file_id_name):
 
     return file_id_name
 
-def main(file_path):
-    norm_method = "Vaha"
-    filename = os.path.basename(file_path)
-    file_id = os.path.splitext(filename)[0]
-    file_id_name = f"{file_id}_{norm_method}"
+def check_accuracy(file_path, precision, roi=None, num_tiles=4, cpu_threads=None):
+    """Compare a cpu precision against the fp32 torch path before relying on it.
+
+    Runs both on the top-left 256px patch of the first cell tiles and prints the
+    largest difference in nucleus probability and the share of pixels given the
+    same nucleus type. fp32 with channels-last should agree exactly, onnx within
+    float rounding, and onnx-int8 is only worth using above 99% type agreement.
+    """
+    file_id_name = SlideManifest.load(file_path).file_id_name(parse_roi(roi))
+
+    _, tile_sources = list_cell_tiles(file_id_name)
+    if not len(tile_sources):
+        print(f"No cell tiles found for file id: {file_id_name}")
+        return None
+    patches = [load_tile(tile_sources[i])[:256, :256, :3] for i in range(min(num_tiles, len(tile_sources)))]
+    batch = torch.from_numpy(np.ascontiguousarray(np.stack(patches)))
+
+    model = segmentor_model(get_segmentor("cpu", "fp32", cpu_threads)).to("cpu")
+    reference = model.infer_batch(model, batch, device="cpu")
+    get_segmentor("cpu", precision, cpu_threads)
+    candidate = model.infer_batch(model, batch, device="cpu")
+
+    np_difference = float(np.abs(reference[0] - candidate[0]).max())
+    type_agreement = float((reference[2] == candidate[2]).mean())
+    print(f"Accuracy of {precision} against fp32 on {len(patches)} patches: "
+          f"max nucleus probability difference {np_difference:.4f}, type agreement {type_agreement:.2%}")
+    return np_difference, type_agreement
+
+def main(file_path, roi=None, direct=False, device="auto", precision="fp32", cpu_threads=None):
+    #roi runs read the tiles patched for that roi only, from their tagged directory
+    slide_manifest = SlideManifest.load(file_path)
+    try:
+        roi = parse_roi(roi, slide_manifest.dimensions)
+    except ValueError as e:
+        logging.error(f"Invalid ROI for {file_path}: {e}")
+        print(f"Invalid ROI: {e}", flush=True)
+        return False
+    file_id_name = slide_manifest.file_id_name(roi)
+    #a resident worker runs many jobs, each reports only its own encoding
+    encode_stats.take()
 
     #create log file
     time_log_path = f"./uploads/{file_id_name}/predict_log.txt"
@@ -258,11 +973,16 @@ def main(file_path):
         logging.info(f"Startig to process run {run_id} for file: {file_id_name}")
 
         try:
-            result = predict(file_id_name)
+            #tile mode counts cells while inference runs, direct mode only has results at the end
+            cell_counter = None if direct else StreamingCellCounter(file_id_name)
+            if direct:
+                result = predict_direct(file_path, file_id_name, roi, device, precision, cpu_threads)
+            else:
+                result = predict(file_id_name, device, precision, cpu_threads, cell_counter)
             if not result:
                 logging.warning(f"Prediction failed for file: {file_id_name}")
                 time_log_file.write(f"File ID: {file_id_name}, Start time: {time.ctime(start_time)}")
-                return
+                return False
             
             logging.info(f"Prediction completed successfully for file: {file_id_name}") #if success
                 #elapsed_time = time.time() - start_time
@@ -272,7 +992,10 @@ def main(file_path):
                 #logging.info(f"Completed processing for file id: {file_id_name}")
 
             try:
-                cellsCount(file_id_name)
+                if cell_counter is not None and cell_counter.started:
+                    cell_counter.finish()
+                else:
+                    cellsCount(file_id_name)
 
                 elapsed_time = time.time() - start_time
                 minutes = int(elapsed_time // 60)
@@ -282,6 +1005,7 @@ def main(file_path):
                 
                 logging.info(f"Completed full processing for file: {file_id_name} in {minutes}m {seconds}s")
                 time_log_file.write(success_msg)
+                return True
 
             except Exception as e:
                 elapsed_time = time.time() - start_time
@@ -313,11 +1037,58 @@ def main(file_path):
             logging.error(f"Processing failed for file {file_id_name}: {str(e)}")
             logging.error(f"Trace: {traceback.format_exc()}")
             time_log_file.write(error_msg)
-            
+
+def serve():
+    """Resident worker for app.py, keeps the model loaded between jobs.
+
+    Reads one json job {"job_id", "file_path", "roi", "direct", "device", "precision"} per stdin line and
+    runs them in order. The usual output of each job is framed by "job-start: <id>"
+    and "job-end: <id> completed|failed" lines.
+    """
+    get_segmentor()
+    print("worker-ready", flush=True)
+
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        job = json.loads(line)
+        print(f"job-start: {job['job_id']}", flush=True)
+        try:
+            result = main(job["file_path"], roi=job.get("roi"), direct=job.get("direct", False),
+                          device=job.get("device", "auto"), precision=job.get("precision", "fp32"))
+        except Exception as e:
+            logging.error(f"Job {job['job_id']} failed: {e}")
+            logging.error(f"Trace: {traceback.format_exc()}")
+            result = False
+        if segmentor is not None:
+            reset_cpu_tuning(segmentor)
+        print(f"job-end: {job['job_id']} {'completed' if result else 'failed'}", flush=True)
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python predict.py <file_path> <file_name>")
+    parser = argparse.ArgumentParser(usage="python predict.py <file_path> [--roi JSON] [--direct] | python predict.py --serve")
+    parser.add_argument("file_path", nargs="?")
+    parser.add_argument("--serve", action="store_true",
+                        help="run as the resident worker of app.py, jobs as json lines on stdin")
+    parser.add_argument("--roi", default=None,
+                        help='level-0 region as json, {"x", "y", "width", "height"} or {"polygon": [[x, y], ...]}')
+    parser.add_argument("--direct", action="store_true", default=os.environ.get("PREDICT_DIRECT", "0") == "1",
+                        help="segment the slide itself in wsi mode, without running patch.py first")
+    parser.add_argument("--device", choices=["auto", "cuda", "cpu"], default=os.environ.get("PREDICT_DEVICE", "auto"),
+                        help="inference device, auto picks cuda when available")
+    parser.add_argument("--precision", choices=PRECISIONS, default=os.environ.get("PREDICT_PRECISION", "fp32"),
+                        help="cpu only: torch fp32, or the model exported to onnxruntime at fp32 or with int8 weights")
+    parser.add_argument("--cpu-threads", type=int, default=int(os.environ.get("PREDICT_CPU_THREADS", "0")) or None,
+                        help="cpu only: intra-op threads, default leaves one core per loader and post-processing worker")
+    parser.add_argument("--check-accuracy", action="store_true",
+                        help="compare --precision against fp32 on a few cell tiles instead of predicting")
+    args = parser.parse_args()
+
+    if args.serve:
+        serve()
+    elif args.file_path is None:
+        parser.error("file_path is required unless --serve is given")
+    elif args.check_accuracy:
+        check_accuracy(args.file_path, args.precision, roi=args.roi, cpu_threads=args.cpu_threads)
     else:
-        file_path = sys.argv[1]
-        main(file_path)
\ No newline at end of file
+        main(args.file_path, roi=args.roi, direct=args.direct, device=args.device, precision=args.precision,
+             cpu_threads=args.cpu_threads)
\ No newline at end of file
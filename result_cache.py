@@ -0,0 +1,89 @@
+import os
+import shutil
+import hashlib
+import numpy as np
+from file_utils import atomic_write
+
+#shared by every job through the uploads volume
+RESULT_CACHE_DIR = "/app/uploads/result_cache"
+#bump when the cached result format or key changes
+RESULT_CACHE_VERSION = 2
+RESULT_CACHE_MAX_BYTES = 10 * 1024 ** 3
+
+
+class ResultCache:
+    """Content-addressed store of per-tile results.
+
+    Keys are the sha256 of the model key and the tile as stored, the encoded
+    bytes of a patch file or the pixels of an in-memory tile, so no tile is
+    decoded to look it up. The model key names the model, tiatoolbox version,
+    precision and device. Values are the tile's .dat as the segmentor saved
+    it. Hits touch the file, so evict() removes the least recently used
+    results once the cache is over max_bytes.
+    """
+
+    def __init__(self, model_key, cache_dir=RESULT_CACHE_DIR, max_bytes=RESULT_CACHE_MAX_BYTES):
+        self.model_key = f"v{RESULT_CACHE_VERSION}_{model_key}"
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, tile_source):
+        """Key of a patch file path or a tile array, the same one is used for get() and put()."""
+        digest = hashlib.sha256(self.model_key.encode())
+        if isinstance(tile_source, str):
+            digest.update(os.path.splitext(tile_source)[1].encode())
+            with open(tile_source, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(chunk)
+        else:
+            tile = np.ascontiguousarray(tile_source)
+            digest.update(f"{tile.shape}{tile.dtype}".encode())
+            digest.update(tile.data)
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.dat")
+
+    def get(self, key, result_path):
+        """Copy a cached result to result_path, False on a miss."""
+        cached_path = self.path(key)
+        try:
+            shutil.copyfile(cached_path, result_path)
+        except FileNotFoundError:
+            self.misses += 1
+            return False
+        os.utime(cached_path)
+        self.hits += 1
+        return True
+
+    def put(self, key, result_path):
+        cached_path = self.path(key)
+        os.makedirs(os.path.dirname(cached_path), exist_ok=True)
+        with atomic_write(cached_path) as tmp_path:
+            shutil.copyfile(result_path, tmp_path)
+
+    def evict(self):
+        """Delete least recently used results until the cache fits in max_bytes, returns bytes freed."""
+        entries = []
+        total_bytes = 0
+        for shard in os.scandir(self.cache_dir) if os.path.isdir(self.cache_dir) else []:
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith(".dat"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total_bytes += stat.st_size
+
+        freed = 0
+        for _, size, path in sorted(entries):
+            if total_bytes - freed <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                freed += size
+            except FileNotFoundError:
+                pass
+        return freed
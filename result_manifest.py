@@ -0,0 +1,115 @@
+import os
+import re
+import json
+import threading
+from file_utils import atomic_write
+
+#tile states, in the order a tile goes through them
+PENDING = "pending"
+DONE = "done"
+COUNTED = "counted"
+MISSING = "missing"
+
+
+def tile_coordinates(tile_name):
+    """Level-0 x, y from a tile name ending in _<x>_<y>."""
+    match = re.search(r'_(\d+)_(\d+)$', tile_name)
+    return int(match.group(1)), int(match.group(2))
+
+class ResultManifest:
+    """Tile to result mapping written at prediction time.
+
+    result_manifest_<id>.json lists every cell tile in prediction order with its
+    level-0 x, y, its result .dat and overlay image, and a status: pending, done once
+    the .dat is saved, counted once its csv row and overlay are written, missing if
+    the .dat was expected but is not there. Paths are relative to uploads/<id>/.
+    source says where the tile images live: png (tile path per entry), store or slide.
+    """
+
+    def __init__(self, file_id_name, meta):
+        self.file_id_name = file_id_name
+        self.meta = meta
+        self.tiles = meta["tiles"]
+        self.lock = threading.Lock()
+        #status changes are flushed to disk about every 1% of the tiles
+        self.save_interval = max(1, len(self.tiles) // 100)
+        self.unsaved = 0
+
+    @staticmethod
+    def base_dir(file_id_name):
+        return f"./uploads/{file_id_name}/"
+
+    @classmethod
+    def path(cls, file_id_name):
+        return os.path.join(cls.base_dir(file_id_name), f"result_manifest_{file_id_name}.json")
+
+    @classmethod
+    def exists(cls, file_id_name):
+        return os.path.exists(cls.path(file_id_name))
+
+    @classmethod
+    def create(cls, file_id_name, tile_names, source, tile_paths=None, overlay_extension="png"):
+        """New manifest with every tile pending, tile {i} of the prediction input saves result/{i}.dat."""
+        base_dir = cls.base_dir(file_id_name)
+        tiles = []
+        for i, tile_name in enumerate(tile_names):
+            x, y = tile_coordinates(tile_name)
+            tiles.append({
+                "index": i,
+                "name": tile_name,
+                "x": x,
+                "y": y,
+                "tile": os.path.relpath(tile_paths[i], base_dir) if tile_paths else None,
+                "result": f"result/{i}.dat",
+                "overlay": f"overlay/overlay_{tile_name}.{overlay_extension}",
+                "status": PENDING,
+            })
+
+        manifest = cls(file_id_name, {"source": source, "tiles": tiles})
+        manifest.save()
+        return manifest
+
+    @classmethod
+    def load(cls, file_id_name):
+        if not cls.exists(file_id_name):
+            return None
+        with open(cls.path(file_id_name)) as f:
+            return cls(file_id_name, json.load(f))
+
+    def __len__(self):
+        return len(self.tiles)
+
+    def file(self, i, key):
+        return os.path.join(self.base_dir(self.file_id_name), self.tiles[i][key])
+
+    def result_path(self, i):
+        return self.file(i, "result")
+
+    def overlay_path(self, i):
+        return self.file(i, "overlay")
+
+    def tile_path(self, i):
+        return self.file(i, "tile")
+
+    def status(self, i):
+        return self.tiles[i]["status"]
+
+    def mark(self, i, status):
+        with self.lock:
+            self.tiles[i]["status"] = status
+            self.unsaved += 1
+            if self.unsaved >= self.save_interval:
+                self.write()
+
+    def indices(self, *statuses):
+        return [tile["index"] for tile in self.tiles if tile["status"] in statuses]
+
+    def save(self):
+        with self.lock:
+            self.write()
+
+    def write(self):
+        with atomic_write(self.path(self.file_id_name)) as tmp_path:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.meta, f)
+        self.unsaved = 0
@@ -0,0 +1,137 @@
+import os
+import re
+import json
+import tifffile
+from openslide import OpenSlide
+from slide_utils import roi_file_id_name
+from file_utils import atomic_write
+
+#bump when fields are added, older manifests are probed again
+SLIDE_MANIFEST_VERSION = 1
+NORM_METHOD = "Vaha"
+#level-0 grid shared by patching, direct prediction and merge
+TILE_SIZE = 1024
+#level 0 page of a Ventana .bif, as read by BifSlide
+BIF_PAGE_INDEX = 2
+
+
+def slide_file_id_name(file_path, roi=None):
+    """uploads/<file_id_name>/ output name of a slide, tagged for an roi run."""
+    file_id = os.path.splitext(os.path.basename(file_path))[0]
+    return roi_file_id_name(f"{file_id}_{NORM_METHOD}", roi)
+
+def probe_openslide(file_path):
+    slide = OpenSlide(file_path)
+    try:
+        properties = slide.properties
+        mpp_x = properties.get("openslide.mpp-x")
+        mpp_y = properties.get("openslide.mpp-y")
+        return {
+            "format": "openslide",
+            "vendor": properties.get("openslide.vendor"),
+            "level_dimensions": [list(dimensions) for dimensions in slide.level_dimensions],
+            "level_downsamples": [float(downsample) for downsample in slide.level_downsamples],
+            "mpp_x": float(mpp_x) if mpp_x else None,
+            "mpp_y": float(mpp_y) if mpp_y else None,
+        }
+    finally:
+        slide.close()
+
+def probe_bif(file_path):
+    with tifffile.TiffFile(file_path) as tif:
+        page = tif.pages[BIF_PAGE_INDEX]
+        if len(page.shape) != 3 or not len(page.dataoffsets):
+            raise ValueError(f"No level 0 image in page {BIF_PAGE_INDEX}")
+        levels = [page] + [level for level in tif.pages[BIF_PAGE_INDEX + 1:]
+                           if len(level.shape) == 3 and level.shape[0] < page.shape[0]]
+        #the scanner writes the resolution into the xmp of the level 0 page
+        mpp = None
+        xmp = page.tags.get("XMP")
+        if xmp is not None:
+            value = xmp.value.decode(errors="ignore") if isinstance(xmp.value, bytes) else str(xmp.value)
+            match = re.search(r'ScanRes="([\d.]+)"', value)
+            mpp = float(match.group(1)) if match else None
+        return {
+            "format": "bif",
+            "vendor": "ventana",
+            "level_dimensions": [[level.shape[1], level.shape[0]] for level in levels],
+            "level_downsamples": [page.shape[1] / level.shape[1] for level in levels],
+            "mpp_x": mpp,
+            "mpp_y": mpp,
+        }
+
+class SlideManifest:
+    """Slide metadata probed once from the file headers, no pixel data is decoded.
+
+    <slide>.slide.json next to the uploaded slide holds the level dimensions and
+    downsamples, mpp, vendor, the level read by every stage (0), the tile grid and
+    the output name. The slide's size and mtime are recorded, so load() probes
+    again when the file was replaced.
+    """
+
+    def __init__(self, meta):
+        self.meta = meta
+
+    @staticmethod
+    def path(file_path):
+        return f"{os.path.splitext(file_path)[0]}.slide.json"
+
+    @classmethod
+    def probe(cls, file_path, tile_size=TILE_SIZE):
+        """Read the headers and write the manifest, raises if the slide cannot be opened."""
+        if file_path.endswith('.svs') or file_path.endswith('.tif'):
+            meta = probe_openslide(file_path)
+        elif file_path.endswith('.bif'):
+            meta = probe_bif(file_path)
+        else:
+            raise ValueError("Unsupported file type")
+
+        stat = os.stat(file_path)
+        width, height = meta["level_dimensions"][0]
+        cols, rows = -(-width // tile_size), -(-height // tile_size)
+        meta.update({
+            "version": SLIDE_MANIFEST_VERSION,
+            "filename": os.path.basename(file_path),
+            "file_id_name": slide_file_id_name(file_path),
+            "size_bytes": stat.st_size,
+            "mtime": stat.st_mtime,
+            "width": width,
+            "height": height,
+            "level": 0,
+            "tile_size": tile_size,
+            "grid": {"cols": cols, "rows": rows, "count": cols * rows},
+        })
+
+        manifest = cls(meta)
+        manifest.save(file_path)
+        return manifest
+
+    @classmethod
+    def load(cls, file_path):
+        """Manifest of the slide, probed now if it is missing or out of date."""
+        try:
+            with open(cls.path(file_path)) as f:
+                meta = json.load(f)
+            stat = os.stat(file_path)
+            if (meta.get("version") == SLIDE_MANIFEST_VERSION and meta["size_bytes"] == stat.st_size
+                    and meta["mtime"] == stat.st_mtime):
+                return cls(meta)
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+        return cls.probe(file_path)
+
+    def save(self, file_path):
+        with atomic_write(self.path(file_path)) as tmp_path:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.meta, f)
+
+    @property
+    def dimensions(self):
+        return self.meta["width"], self.meta["height"]
+
+    @property
+    def tile_size(self):
+        return self.meta["tile_size"]
+
+    def file_id_name(self, roi=None):
+        return roi_file_id_name(self.meta["file_id_name"], roi)
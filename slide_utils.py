@@ -0,0 +1,279 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+import tifffile
+from PIL import Image
+from openslide import OpenSlide
+
+#longest side of the thumbnail used for tissue detection
+THUMBNAIL_SIZE = 2048
+
+
+class BifSlide:
+    """Lazy reader for the level-0 page of a Ventana .bif.
+
+    Only the TIFF tiles (or strips) overlapping a requested region are read and
+    decoded, so memory depends on the region size rather than the slide size.
+    Regions are assembled the same way tifffile's page.asarray() would.
+    """
+
+    def __init__(self, file_path, page_index=2, cache_size=16):
+        self.tif = tifffile.TiffFile(file_path)
+        self.page = self.tif.pages[page_index]
+        self.levels = [self.page] + [
+            page for page in self.tif.pages[page_index + 1:]
+            if len(page.shape) == 3 and page.shape[0] < self.page.shape[0]
+        ]
+        self.shape = self.page.shape
+        self.lock = threading.Lock()
+
+        if self.page.is_tiled:
+            self.segment_height, self.segment_width = self.page.tilelength, self.page.tilewidth
+        else:
+            self.segment_height, self.segment_width = self.page.rowsperstrip, self.page.imagewidth
+        self.segments_across = -(-self.shape[1] // self.segment_width)
+
+        #planar (separate) samples are rare for brightfield, fall back to one full decode
+        self.full_array = None
+        if self.page.planarconfig != 1 and self.shape[-1] > 1:
+            self.full_array = self.page.asarray()
+
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+
+    def read_segment(self, index):
+        if index in self.cache:
+            self.cache.move_to_end(index)
+            return self.cache[index]
+
+        offset = self.page.dataoffsets[index]
+        bytecount = self.page.databytecounts[index]
+        if bytecount == 0:
+            segment = np.zeros((self.segment_height, self.segment_width, self.shape[-1]), dtype=self.page.dtype)
+        else:
+            fh = self.tif.filehandle
+            fh.seek(offset)
+            data = fh.read(bytecount)
+            segment, _, shape = self.page.decode(data, index, jpegtables=self.page.jpegtables)
+            segment = segment.reshape(shape)[0]
+
+        self.cache[index] = segment
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return segment
+
+    def read_region(self, x, y, width, height):
+        """RGB array for the level-0 region, cropped at the slide edge like the in-memory slice was."""
+        img_height, img_width = self.shape[:2]
+        width = min(width, img_width - x)
+        height = min(height, img_height - y)
+
+        if self.full_array is not None:
+            return self.full_array[y:y + height, x:x + width]
+
+        region = np.zeros((height, width, self.shape[-1]), dtype=self.page.dtype)
+        with self.lock:
+            for seg_y in range(y // self.segment_height, (y + height - 1) // self.segment_height + 1):
+                for seg_x in range(x // self.segment_width, (x + width - 1) // self.segment_width + 1):
+                    segment = self.read_segment(seg_y * self.segments_across + seg_x)
+                    top = seg_y * self.segment_height
+                    left = seg_x * self.segment_width
+
+                    #overlap of this segment with the requested region, in slide coordinates
+                    y0, y1 = max(y, top), min(y + height, top + segment.shape[0])
+                    x0, x1 = max(x, left), min(x + width, left + segment.shape[1])
+                    if y1 <= y0 or x1 <= x0:
+                        continue
+                    region[y0 - y:y1 - y, x0 - x:x1 - x] = segment[y0 - top:y1 - top, x0 - left:x1 - left]
+        return region
+
+    def get_thumbnail(self, max_size):
+        """Whole-slide RGB array no larger than max_size, decoded from the smallest usable pyramid page."""
+        page = self.page
+        for level in self.levels:
+            if max(level.shape[:2]) >= max_size:
+                page = level
+        with self.lock:
+            level_array = page.asarray() if page is not self.page else None
+        if level_array is None:
+            level_array = self.read_region(0, 0, self.shape[1], self.shape[0])
+        step = max(1, int(np.ceil(max(level_array.shape[:2]) / max_size)))
+        return np.ascontiguousarray(level_array[::step, ::step, :3])
+
+    def close(self):
+        self.tif.close()
+
+#function to open a slide with openslide, or tifffile for .bif
+def open_slide(file_path):
+    if file_path.endswith('.svs') or file_path.endswith('.tif'):
+        slide = OpenSlide(file_path)
+        if_openslide = True
+
+    elif file_path.endswith('.bif'):
+        slide = BifSlide(file_path)
+        if_openslide = False
+    else:
+        raise ValueError("Unsupported file type")
+
+    return slide, if_openslide
+
+#function to read slides and convert into numpy array
+def read_slide(image_data, x, y, width, height, if_openslide = True, level = 0):
+    if if_openslide:
+        region = image_data.read_region((x, y), level, (width, height))
+        region = region.convert('RGB')
+        region = np.asarray(region)
+        return region
+    else:
+        #the bif reader keeps the patch within bounds and decodes only the tiles it needs
+        region = image_data.read_region(x, y, width, height)
+        return np.asarray(region)
+
+def read_thumbnail(image_data, if_openslide, max_size=THUMBNAIL_SIZE):
+    """Low resolution RGB view of the whole slide, taken from the pyramid where possible."""
+    if if_openslide:
+        thumbnail = image_data.get_thumbnail((max_size, max_size)).convert('RGB')
+        return np.asarray(thumbnail)
+    else:
+        return image_data.get_thumbnail(max_size)
+
+#tissue detection
+def build_tissue_mask(thumbnail, threshold_std):
+    """Boolean mask of thumbnail pixels that look like tissue.
+
+    Uses the same per-pixel channel std as the level-0 blank test, so glass and
+    the black padding outside the scanned area both fall below the threshold.
+    """
+    mask = np.std(thumbnail.astype(np.float32), axis=-1) > threshold_std
+    #grow by one pixel so thin tissue at tile borders is not lost to downsampling
+    grown = mask.copy()
+    grown[1:, :] |= mask[:-1, :]
+    grown[:-1, :] |= mask[1:, :]
+    grown[:, 1:] |= mask[:, :-1]
+    grown[:, :-1] |= mask[:, 1:]
+    return grown
+
+def mask_scale(mask, img_width, img_height):
+    """Level-0 pixels per mask pixel along x and y."""
+    return img_width / mask.shape[1], img_height / mask.shape[0]
+
+def mask_window(mask, img_width, img_height, x, y, width, height):
+    scale_x, scale_y = mask_scale(mask, img_width, img_height)
+    x0 = int(x // scale_x)
+    y0 = int(y // scale_y)
+    x1 = max(x0 + 1, int(np.ceil((x + width) / scale_x)))
+    y1 = max(y0 + 1, int(np.ceil((y + height) / scale_y)))
+    return x0, y0, x1, y1
+
+def tile_has_tissue(mask, img_width, img_height, x, y, width, height):
+    x0, y0, x1, y1 = mask_window(mask, img_width, img_height, x, y, width, height)
+    return bool(mask[y0:y1, x0:x1].any())
+
+def synthesize_background(thumbnail, img_width, img_height, x, y, width, height, if_openslide = True):
+    """Blank tile upsampled from the thumbnail, shaped like read_slide would return it."""
+    #openslide pads reads past the slide edge, the tifffile path crops them
+    in_width = min(width, img_width - x)
+    in_height = min(height, img_height - y)
+    if not if_openslide:
+        width, height = in_width, in_height
+
+    x0, y0, x1, y1 = mask_window(thumbnail, img_width, img_height, x, y, in_width, in_height)
+    region = Image.fromarray(thumbnail[y0:y1, x0:x1]).resize((in_width, in_height), Image.NEAREST)
+
+    tile = np.zeros((height, width, 3), dtype=np.uint8)
+    tile[:in_height, :in_width] = np.asarray(region)
+    return tile
+
+def tissue_mask_path(output_dir, file_id_name):
+    return os.path.join(output_dir, f"tissue_mask_{file_id_name}.png")
+
+def save_tissue_mask(mask, mask_path):
+    Image.fromarray(mask.astype(np.uint8) * 255).save(mask_path)
+
+def load_tissue_mask(mask_path):
+    if not os.path.exists(mask_path):
+        return None
+    return np.asarray(Image.open(mask_path)) > 0
+
+#region of interest, in level-0 coordinates
+def parse_roi(roi, dimensions=None):
+    """Validate an ROI given as a dict or json string.
+
+    Either a rectangle {"x", "y", "width", "height"} or {"polygon": [[x, y], ...]}.
+    Returns a dict with the canonical definition plus its "bbox" (x, y, width, height).
+    With the slide (width, height) given, the bbox must also lie inside the slide.
+    """
+    if roi is None or roi == "":
+        return None
+    if isinstance(roi, str):
+        roi = json.loads(roi)
+    if not isinstance(roi, dict):
+        raise ValueError("ROI must be a json object")
+
+    if "polygon" in roi:
+        points = [(int(px), int(py)) for px, py in roi["polygon"]]
+        if len(points) < 3:
+            raise ValueError("ROI polygon needs at least 3 points")
+        xs = [px for px, _ in points]
+        ys = [py for _, py in points]
+        bbox = (min(xs), min(ys), max(xs) - min(xs), max(ys) - min(ys))
+        parsed = {"polygon": [list(point) for point in points]}
+    else:
+        bbox = tuple(int(roi[key]) for key in ("x", "y", "width", "height"))
+        parsed = dict(zip(("x", "y", "width", "height"), bbox))
+
+    if bbox[2] <= 0 or bbox[3] <= 0 or bbox[0] < 0 or bbox[1] < 0:
+        raise ValueError("ROI must have a positive size inside the slide")
+    if dimensions is not None and (bbox[0] + bbox[2] > dimensions[0] or bbox[1] + bbox[3] > dimensions[1]):
+        raise ValueError(f"ROI bbox {bbox} is not inside the {dimensions[0]}x{dimensions[1]} slide")
+    parsed["bbox"] = bbox
+    return parsed
+
+def roi_tag(roi):
+    """Short stable tag used to name the outputs of an ROI run, e.g. roi-1a2b3c4d."""
+    definition = {key: value for key, value in roi.items() if key != "bbox"}
+    digest = hashlib.sha1(json.dumps(definition, sort_keys=True).encode()).hexdigest()
+    return f"roi-{digest[:8]}"
+
+def roi_file_id_name(file_id_name, roi):
+    return f"{file_id_name}_{roi_tag(roi)}" if roi else file_id_name
+
+def point_in_polygon(px, py, polygon):
+    inside = False
+    for (x0, y0), (x1, y1) in zip(polygon, polygon[1:] + polygon[:1]):
+        if (y0 > py) != (y1 > py) and px < x0 + (py - y0) * (x1 - x0) / (y1 - y0):
+            inside = not inside
+    return inside
+
+def segments_intersect(a, b, c, d):
+    def orient(p, q, r):
+        return (q[0] - p[0]) * (r[1] - p[1]) - (q[1] - p[1]) * (r[0] - p[0])
+    return (orient(a, b, c) * orient(a, b, d) < 0) and (orient(c, d, a) * orient(c, d, b) < 0)
+
+def tile_in_roi(roi, x, y, width, height):
+    """True when the level-0 tile overlaps the ROI."""
+    if roi is None:
+        return True
+    bx, by, bw, bh = roi["bbox"]
+    if x >= bx + bw or x + width <= bx or y >= by + bh or y + height <= by:
+        return False
+    if "polygon" not in roi:
+        return True
+
+    polygon = [tuple(point) for point in roi["polygon"]]
+    corners = [(x, y), (x + width, y), (x + width, y + height), (x, y + height)]
+    if any(x <= px <= x + width and y <= py <= y + height for px, py in polygon):
+        return True
+    if any(point_in_polygon(cx, cy, polygon) for cx, cy in corners):
+        return True
+    edges = list(zip(corners, corners[1:] + corners[:1]))
+    return any(segments_intersect(a, b, c, d)
+               for a, b in edges for c, d in zip(polygon, polygon[1:] + polygon[:1]))
+
+def save_roi(roi, output_dir):
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, "roi.json"), 'w') as f:
+        json.dump({key: value for key, value in roi.items() if key != "bbox"}, f)
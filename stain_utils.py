@@ -0,0 +1,85 @@
+import os
+import numpy as np
+import tiatoolbox
+from tiatoolbox import data
+from tiatoolbox.tools import stainnorm
+from file_utils import atomic_write
+
+#fitted target model is shared by every job through the uploads volume
+STAIN_MODEL_DIR = "/app/uploads/stain_model"
+#bump when the stored format or the fitting procedure changes
+STAIN_MODEL_VERSION = 1
+#tissue pixels sampled from the thumbnail for the per-slide source fit
+SLIDE_FIT_PIXELS = 100000
+
+#optical density of every uint8 value, same as tiatoolbox rgb2od
+OD_LUT = np.maximum(-np.log(np.maximum(np.arange(256), 1) / 255.0), 1e-6)
+
+
+def stain_model_key():
+    return f"vahadane_v{STAIN_MODEL_VERSION}_tiatoolbox-{tiatoolbox.__version__}"
+
+def load_target_stain_model(model_dir=STAIN_MODEL_DIR):
+    """Target stain matrix and max concentrations, fitted once and then read from disk."""
+    model_path = os.path.join(model_dir, f"{stain_model_key()}.npz")
+    if os.path.exists(model_path):
+        with np.load(model_path) as model:
+            return model["stain_matrix_target"], model["maxC_target"]
+
+    normalizer = stainnorm.get_normalizer("Vahadane")
+    normalizer.fit(data.stain_norm_target())
+
+    os.makedirs(model_dir, exist_ok=True)
+    with atomic_write(model_path) as tmp_path:
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, stain_matrix_target=normalizer.stain_matrix_target, maxC_target=normalizer.maxC_target)
+
+    return normalizer.stain_matrix_target, normalizer.maxC_target
+
+def get_stain_normalizer(model_dir=STAIN_MODEL_DIR):
+    """Vahadane normalizer with the cached target model, transform still fits each tile's source stains."""
+    stain_matrix_target, max_c_target = load_target_stain_model(model_dir)
+    stain_normalizer = stainnorm.get_normalizer("Vahadane")
+    stain_normalizer.stain_matrix_target = stain_matrix_target
+    stain_normalizer.maxC_target = max_c_target
+    return stain_normalizer
+
+class SlideStainNormalizer:
+    """Vahadane mapping with the source stains estimated once per slide.
+
+    The source stain matrix and max concentrations come from tissue pixels of
+    the slide thumbnail, so transform() is a single 3x3 colour mapping in
+    optical density space instead of a dictionary-learning fit per tile.
+    """
+
+    def __init__(self, stain_matrix_source, max_c_source, stain_matrix_target, max_c_target):
+        self.stain_matrix_source = stain_matrix_source
+        self.max_c_source = max_c_source
+        #od -> source concentrations -> rescaled -> target od, folded into one matrix
+        scale = (max_c_target / max_c_source).reshape(2)
+        self.od_mapping = np.linalg.pinv(stain_matrix_source) @ np.diag(scale) @ stain_matrix_target
+
+    @classmethod
+    def from_thumbnail(cls, thumbnail, mask=None, model_dir=STAIN_MODEL_DIR):
+        stain_matrix_target, max_c_target = load_target_stain_model(model_dir)
+
+        pixels = thumbnail.reshape(-1, 3)
+        if mask is not None and mask.any():
+            pixels = pixels[mask.reshape(-1)]
+        if len(pixels) > SLIDE_FIT_PIXELS:
+            pixels = pixels[np.random.default_rng(0).choice(len(pixels), SLIDE_FIT_PIXELS, replace=False)]
+
+        extractor = stainnorm.get_normalizer("Vahadane").extractor
+        stain_matrix_source = extractor.get_stain_matrix(np.ascontiguousarray(pixels[np.newaxis]))
+
+        od = OD_LUT[pixels]
+        source_concentrations = od @ np.linalg.pinv(stain_matrix_source)
+        max_c_source = np.percentile(source_concentrations, 99, axis=0).reshape((1, 2))
+
+        return cls(stain_matrix_source, max_c_source, stain_matrix_target, max_c_target)
+
+    def transform(self, img):
+        od = OD_LUT[img[..., :3]].reshape(-1, 3)
+        trans = 255 * np.exp(-(od @ self.od_mapping))
+        np.clip(trans, 0, 255, out=trans)
+        return trans.reshape(img.shape[:-1] + (3,)).astype(np.uint8)
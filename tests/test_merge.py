@@ -0,0 +1,18 @@
+import pytest
+
+pytest.importorskip("pyvips")
+pytest.importorskip("openslide")
+
+from merge import overlay_extent
+
+
+def test_padded_edge_tile_keeps_full_extent():
+    #openslide pads the edge tile to 1024, its overlay at 0.3 is round(1024 * 0.3) px
+    assert overlay_extent(307, 0.3, 1024, 300) == 1024
+
+def test_cropped_edge_tile_keeps_cropped_extent():
+    #BifSlide crops the edge tile to the 300 px left of the slide
+    assert overlay_extent(90, 0.3, 1024, 300) == 300
+
+def test_full_tile_not_shrunk_by_rounding():
+    assert overlay_extent(round(1024 * 0.3), 0.3, 1024, 5000) == 1024